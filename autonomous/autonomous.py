@@ -5,6 +5,7 @@ from components import intake
 from components import defeater
 from components import bno055
 from components.boulder_automation import BoulderAutomation
+from components.snapshot import Snapshot
 from wpilib import CANTalon
 import logging
 
@@ -30,6 +31,7 @@ class ObstacleHighGoal:
     defeater_motor = CANTalon
     bno055 = bno055.BNO055
     boulder_automation = BoulderAutomation
+    snapshot = Snapshot
 
     def __init__(self, delta_x, delta_y, delta_heading=0.0, portcullis=False):
         self.straight = 4.1
@@ -48,6 +50,7 @@ class ObstacleHighGoal:
         # Reset the IMU
         self.bno055.resetHeading()
         self.chassis.set_heading_setpoint(self.bno055.getAngle())
+        self.chassis.reset_odometry()
         self.chassis.heading_hold_pid.reset()
         self.chassis.heading_hold = True
         self.chassis.field_oriented = True
@@ -64,40 +67,43 @@ class ObstacleHighGoal:
         """Cleanup after auto routine"""
         self.chassis.range_setpoint = 0.0
         self.chassis.track_vision = False
+        self.chassis.cancel_displacement()
         self.boulder_automation.done()
 
     def on_iteration(self, tm):
         '''Drive forward the same amount, then move by delta_x and delta_y
         to the position where the vision and range finder take over.
         Final change in heading is specified too.'''
-        rf = self.chassis.range_finder.pidGet()
+        self.snapshot.update()
         #self.logger.info("VISION OUTPUT: " + str(self.chassis.vision.pidGet()) + " COUNTER: " + str(self.chassis.vision.no_vision_counter))
         if self.state == States.init:
             if self.portcullis:
                 self.defeater_motor.set(-0.5)
             if not self.chassis.onTarget():
                 return
-            self.chassis.field_displace(self.straight, 0.0)
+            duration = self.chassis.field_displace(self.straight, 0.0, profiled=True)
             self.state = States.through_obstacle
-            self.chassis.distance_pid.setOutputRange(-0.55, 0.55)
-            self.logger.info("SETPOINT: " + str(self.chassis.distance_pid.getSetpoint()))
-        if self.state == States.through_obstacle and self.chassis.distance_pid.onTarget():
+            self.logger.info("Through obstacle, expected time: " + str(duration))
+        if self.state == States.through_obstacle and self.chassis.on_profile_target():
             # Let the distance PID do its magic...
             # Turn off the distance PID, and spin to the right angle
-            self.logger.info("Obstacle finished, distance: " + str(self.chassis.distance))
+            self.logger.info("Obstacle finished, distance: " + str(self.chassis.distance)
+                             + " position: " + str((self.chassis.odometry_x, self.chassis.odometry_y)))
             self.chassis.distance_pid.disable()
             self.chassis.heading_hold_pid.setSetpoint(constrain_angle(self.chassis.heading_hold_pid.getSetpoint() + self.delta_heading))
             self.defeater_motor.set(0.3)
             self.state = States.spinning
         if self.state == States.spinning and self.chassis.heading_hold_pid.onTarget():
             # Turn on the distance PID for the next displacement
-            self.chassis.field_displace(self.delta_x, self.delta_y)
+            duration = self.chassis.field_displace(self.delta_x, self.delta_y, profiled=True)
             self.state = States.strafing
-        if self.state == States.strafing and self.chassis.distance_pid.onTarget():
+            self.logger.info("Strafing, expected time: " + str(duration))
+        if self.state == States.strafing and self.chassis.on_profile_target():
             # Dead reckoning is done - engage the rangefinder
             # Leave the distance PID running as it will read the rf for us
             self.chassis.distance_pid.setOutputRange(-0.4, 0.4)
-            self.logger.info("Strafing finished, distance: " + str(self.chassis.distance))
+            self.logger.info("Strafing finished, distance: " + str(self.chassis.distance)
+                             + " position: " + str((self.chassis.odometry_x, self.chassis.odometry_y)))
             self.state = States.range_finding
             self.chassis.distance_pid.reset()
             self.chassis.zero_encoders()
@@ -245,15 +251,16 @@ class Portcullis5RightTower(ObstacleHighGoal):
 class ApproachObstacle:
     MODE_NAME = "Approach Obstacle"
     chassis = Chassis
+    snapshot = Snapshot
 
     def __init__(self):
         pass
 
     def on_enable(self):
-        self.chassis.field_displace(1.1, 0.0)
+        self.chassis.field_displace(1.1, 0.0, onboard=True)
 
     def on_iteration(self, tm):
-        pass
+        self.snapshot.update()
 
     def on_disable(self):
-        pass
+        self.chassis.cancel_displacement()
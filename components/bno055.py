@@ -4,9 +4,15 @@ from wpilib import GyroBase
 import hal
 import math
 
+from collections import namedtuple
 import logging
 
 
+# The values read from the gyro by BNO055.sample()
+GyroReading = namedtuple('GyroReading', ['heading', 'raw_heading', 'heading_rate',
+                                         'pitch', 'roll'])
+
+
 class BNO055(GyroBase):
     """Class to read euler values in radians from the I2C bus"""
 
@@ -42,6 +48,7 @@ class BNO055(GyroBase):
             self.reverse_axis(False, False, False)
         except:
             pass
+        self.sample()
 
     def reverse_axis(self, x, y, z):
         """Reverse the axis directions, xyz are booleans"""
@@ -107,7 +114,20 @@ class BNO055(GyroBase):
         return -self.getEuler(BNO055.BNO055_GYRO_DATA_Z_LSB_ADDR)
 
     def resetHeading(self, heading=math.pi):
-        self.offset = self.getRawHeading() - heading
+        raw_heading = self.getRawHeading()
+        self.offset = raw_heading - heading
+        # Keep the reading consistent with the new offset until the next sample
+        self.reading = self.reading._replace(
+            heading=math.atan2(math.sin(heading), math.cos(heading)),
+            raw_heading=raw_heading)
+
+    def sample(self):
+        """Read everything we use from the gyro into .reading"""
+        raw_heading = self.getRawHeading()
+        angle = raw_heading - self.offset
+        self.reading = GyroReading(math.atan2(math.sin(angle), math.cos(angle)),
+                                   raw_heading, self.getHeadingRate(),
+                                   self.getPitch(), self.getRoll())
 
     def execute(self):
         pass  # Keep MagicBot happy!
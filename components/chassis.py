@@ -1,12 +1,13 @@
 
 import math
 
-from wpilib import CANTalon, PIDController
+from wpilib import CANTalon, PIDController, Timer
 from wpilib.interfaces import PIDOutput, PIDSource
 
 from .bno055 import BNO055
 from .vision import Vision
 from .range_finder import RangeFinder
+from .talon import CachedTalon
 
 
 class BlankPIDOutput(PIDOutput):
@@ -17,9 +18,59 @@ class BlankPIDOutput(PIDOutput):
         self.output = output
 
 
+class TrapezoidalProfile:
+    """Position and velocity over time for a move of distance metres,
+    accelerating and decelerating at max_acceleration and never going
+    faster than max_speed."""
+
+    def __init__(self, distance, max_speed, max_acceleration):
+        self.distance = distance
+        self.max_acceleration = max_acceleration
+        # Short moves never get up to max_speed (triangular profile)
+        self.peak_speed = min(max_speed, math.sqrt(distance * max_acceleration))
+        self.accel_time = self.peak_speed / max_acceleration
+        accel_distance = self.peak_speed * self.accel_time / 2.0
+        if self.peak_speed > 0.0:
+            self.cruise_time = (distance - 2.0 * accel_distance) / self.peak_speed
+        else:
+            self.cruise_time = 0.0
+        self.duration = 2.0 * self.accel_time + self.cruise_time
+
+    def sample(self, t):
+        """Return the (position, velocity) t seconds into the move"""
+        a = self.max_acceleration
+        if t <= 0.0:
+            return 0.0, 0.0
+        if t < self.accel_time:
+            return a * t ** 2 / 2.0, a * t
+        cruise_end = self.accel_time + self.cruise_time
+        if t < cruise_end:
+            return (self.peak_speed * (t - self.accel_time / 2.0),
+                    self.peak_speed)
+        if t < self.duration:
+            remaining = self.duration - t
+            return self.distance - a * remaining ** 2 / 2.0, a * remaining
+        return self.distance, 0.0
+
+
 class Chassis:
     correct_range = 1.65 # m
 
+    # Limits and correction gain for motion profiled field_displace
+    profile_max_speed = 1.5  # m/s
+    profile_max_acceleration = 2.0  # m/s/s
+    profile_kp = 1.0  # output per metre behind the profile
+    profile_tolerance = 0.05  # m
+    # How close the Talons' position loops must get in onboard field_displace
+    onboard_tolerance = 0.05  # m
+    # Hand an onboard move over to the distance PID if it takes longer than
+    # onboard_timeout plus the time to cover it at onboard_min_speed, or if
+    # the heading wanders off by more than onboard_max_heading_error, as
+    # heading hold can't turn the robot while the Talons are driving
+    onboard_timeout = 1.0  # s
+    onboard_min_speed = 0.5  # m/s
+    onboard_max_heading_error = math.radians(5.0)
+
     length = 498.0  # mm
     width = 600.0  # mm
 
@@ -64,6 +115,11 @@ class Chassis:
                                     'drive_encoder':True, 'reverse_drive_encoder':True},             
                            'vz': {'x': vz_components['x'], 'y': vz_components['y']}}                 
                      }
+    # The vz components of each module as the rows of a matrix, in a fixed
+    # order, so drive() does no dict lookups
+    module_names = ('a', 'b', 'c', 'd')
+    module_vz = tuple((params['vz']['x'], params['vz']['y'])
+                      for params in map(module_params.get, module_names))
     # Use the magic here!
     bno055 = BNO055
     vision = Vision
@@ -81,6 +137,7 @@ class Chassis:
         for name, params in Chassis.module_params.items():
             self._modules[name] = SwerveModule(**(params['args']))
             self._modules[name]._drive.setVoltageRampRate(50.0)
+        self._module_list = [self._modules[name] for name in Chassis.module_names]
         self.field_oriented = True
         self.inputs = [0.0, 0.0, 0.0, 0.0]
         self.vx = self.vy = self.vz = 0.0
@@ -106,20 +163,42 @@ class Chassis:
         self.reset_distance_pid = False
         self.pid_counter = 0
 
+        # Field frame pose, integrated from the modules and gyro every tick
+        self.odometry_x = self.odometry_y = self.odometry_heading = 0.0
+
+        # The motion profile being followed by field_displace, if any
+        self.profile = None
+        self.profile_start_time = self.profile_end_time = 0.0
+        # Drive output of 1.0 in m/s (Talon speeds are counts per 100ms)
+        module = self._module_list[0]
+        self.max_speed = module.drive_max_speed * 10.0 / module.drive_counts_per_metre
+
+        # An onboard field_displace waits for the modules to point the right
+        # way, then hands onboard_distance to the Talons' position loops
+        self.onboard_displacement = False
+        self.onboard_started = False
+        self.onboard_distance = 0.0
+        self.onboard_deadline = 0.0
+        # Set if the last onboard move was handed over to the distance PID
+        self.onboard_fallback = False
+
     def on_enable(self):
         self.bno055.resetHeading()
         self.heading_hold = True
         self.field_oriented = True
         self.heading_hold_pid.setSetpoint(self.bno055.getAngle())
         self.heading_hold_pid.reset()
+        self.reset_odometry()
         # Update the current module steer setpoint to be the current position
         # Stops the unwind problem
         for module in self._modules.values():
             module._steer.set(module._steer.getPosition())
 
     def onTarget(self):
+        # Compare against the setpoint rather than the Talon's closed loop
+        # error, which is out of date if we steered since the last snapshot
         for module in self._modules.values():
-            if not abs(module._steer.getError()) < 50:
+            if not abs(module.steer_error) < 50:
                 return False
         return True
 
@@ -146,18 +225,138 @@ class Chassis:
         for module in self._modules.values():
             module.zero_distance()
 
-    def field_displace(self, x, y):
+    def reset_odometry(self, x=0.0, y=0.0):
+        '''Set the field position to x,y and start integrating from here.
+        Unlike zero_encoders this does not affect the distance PID.'''
+        for module in self._module_list:
+            module.odometry_delta()
+        self.odometry_x = x
+        self.odometry_y = y
+        self.odometry_heading = self.bno055.reading.heading
+
+    def update_odometry(self):
+        heading = self.bno055.reading.heading
+        # Average the module displacements in the robot frame. The
+        # rotational parts cancel out as the modules are symmetric.
+        dx = dy = 0.0
+        for module in self._module_list:
+            d = module.odometry_delta()
+            direction = module.measured_direction
+            dx += d * math.cos(direction)
+            dy += d * math.sin(direction)
+        dx /= 4.0
+        dy /= 4.0
+        # Rotate into the field frame (the inverse of field_orient) with the
+        # heading halfway through the tick
+        mid = self.odometry_heading + constrain_angle(heading - self.odometry_heading) / 2.0
+        self.odometry_x += dx * math.cos(mid) - dy * math.sin(mid)
+        self.odometry_y += dx * math.sin(mid) + dy * math.cos(mid)
+        self.odometry_heading = heading
+
+    def field_displace(self, x, y, profiled=False, onboard=False):
         '''Use the distance PID to displace the robot by x,y
-        in field reference frame.'''
+        in field reference frame.
+        If profiled, follow a trapezoidal motion profile instead, and
+        return the number of seconds it is expected to take.
+        If onboard, run the move in the drive Talons' position loops.'''
         d = math.sqrt((x ** 2 + y ** 2))
-        fx, fy = field_orient(x, y, self.bno055.getHeading())
+        fx, fy = field_orient(x, y, self.bno055.reading.heading)
         self.distance_pid_heading = math.atan2(fy, fx)
         self.distance_pid.disable()
         self.zero_encoders()
+        self.onboard_displacement = False
+        self.onboard_fallback = False
+        if onboard:
+            self.profile = None
+            # Point the modules exactly along the move, so that every
+            # drive goes forwards
+            for module in self._module_list:
+                module.steer(self.distance_pid_heading)
+            self.onboard_distance = d
+            self.onboard_started = False
+            self.onboard_displacement = True
+            self.onboard_deadline = (Timer.getFPGATimestamp() + self.onboard_timeout +
+                                     d / self.onboard_min_speed)
+            return
+        if profiled:
+            self.profile = TrapezoidalProfile(d, self.profile_max_speed,
+                                              self.profile_max_acceleration)
+            self.profile_start_time = Timer.getFPGATimestamp()
+            self.profile_end_time = self.profile_start_time + self.profile.duration
+            return self.profile.duration
+        self.profile = None
         self.distance_pid.setSetpoint(d)
         self.distance_pid.reset()
         self.distance_pid.enable()
 
+    def on_profile_target(self):
+        '''Has the last profiled field_displace finished?'''
+        return self.profile is None
+
+    def on_onboard_target(self):
+        '''Has the last onboard field_displace finished?'''
+        if self.onboard_displacement:
+            return False
+        if self.onboard_fallback:
+            return self.distance_pid.onTarget()
+        return True
+
+    def cancel_displacement(self):
+        '''Stop any profiled or onboard field_displace'''
+        self.profile = None
+        self.onboard_displacement = False
+        self.onboard_fallback = False
+
+    def modules_on_position_target(self):
+        # One pass over this loop's readings of every drive Talon
+        for module in self._module_list:
+            tolerance = self.onboard_tolerance * module.drive_counts_per_metre
+            if not abs(module.position_error) < tolerance:
+                return False
+        return True
+
+    def fall_back_to_distance_pid(self):
+        '''Finish an onboard move with the distance PID instead. The
+        encoders were zeroed when it started, so the setpoint is the same.'''
+        self.onboard_displacement = False
+        self.onboard_fallback = True
+        self.distance_pid.setSetpoint(self.onboard_distance)
+        self.distance_pid.reset()
+        self.distance_pid.enable()
+
+    def update_onboard_displacement(self):
+        '''Start the drives once the modules are pointing the right way,
+        then wait for them to get there. Returns True while the Talons
+        are in control.'''
+        heading_error = constrain_angle(self.heading_hold_pid.getSetpoint() -
+                                        self.bno055.reading.heading)
+        if (Timer.getFPGATimestamp() > self.onboard_deadline or
+                (self.heading_hold and self.onboard_started and
+                 abs(heading_error) > self.onboard_max_heading_error)):
+            self.fall_back_to_distance_pid()
+            return False
+        if not self.onboard_started:
+            if self.onTarget():
+                for module in self._module_list:
+                    module.drive_to(self.onboard_distance)
+                self.onboard_started = True
+            return True
+        if self.modules_on_position_target():
+            self.onboard_displacement = False
+            return False
+        return True
+
+    def follow_profile(self):
+        '''Return the drive output for this point in the profile:
+        the profile's speed plus a correction for how far behind we are.'''
+        t = Timer.getFPGATimestamp() - self.profile_start_time
+        position, velocity = self.profile.sample(t)
+        error = position - self.distance
+        if t >= self.profile.duration and abs(error) < self.profile_tolerance:
+            self.profile = None
+            return 0.0
+        return velocity / self.max_speed + self.profile_kp * error
+
     def pidGet(self):
         return self.distance
 
@@ -172,37 +371,27 @@ class Chassis:
         return distances / 4.0
 
     def drive(self, vX, vY, vZ, absolute=False):
-        motor_vectors = {}
-        for name, params in Chassis.module_params.items():
-            motor_vectors[name] = {'x': vX + vZ * params['vz']['x'],
-                                   'y': vY + vZ * params['vz']['y']
-                                   }
-        # convert the vectors to polar coordinates
-        polar_vectors = {}
+        # Each module's vector is the translation plus vZ times its row of
+        # module_vz. Work out every magnitude before steering, so they can
+        # all be scaled down by the largest.
+        vectors = [(vX + vZ * vz_x, vY + vZ * vz_y) for vz_x, vz_y in Chassis.module_vz]
+        magnitudes = [math.sqrt(x ** 2 + y ** 2) for x, y in vectors]
         max_mag = 1.0
-        for name, motor_vector in motor_vectors.items():
-            polar_vectors[name] = {'dir': math.atan2(motor_vector['y'],
-                                                     motor_vector['x']
-                                                     ),
-                                   'mag': math.sqrt(motor_vector['x'] ** 2
-                                                    + motor_vector['y'] ** 2
-                                                    )
-                                   }
-            if abs(polar_vectors[name]['mag']) > max_mag:
-                max_mag = polar_vectors[name]['mag']
-
-        for name in polar_vectors.keys():
-            polar_vectors[name]['mag'] /= max_mag
-            if absolute:
-                polar_vectors[name]['mag'] = None
-                continue
-
-        for name, polar_vector in polar_vectors.items():
-            self._modules[name].steer(polar_vector['dir'], polar_vector['mag'])
+        for mag in magnitudes:
+            if mag > max_mag:
+                max_mag = mag
+
+        for module, (x, y), mag in zip(self._module_list, vectors, magnitudes):
+            module.steer(math.atan2(y, x), None if absolute else mag / max_mag)
 
     def execute(self):
+        self.update_odometry()
+        # The modules are left alone while the Talons run an onboard move,
+        # but heading hold keeps running so it can take over afterwards
+        onboard = self.onboard_displacement and self.update_onboard_displacement()
+        heading = self.bno055.reading.heading
         if self.field_oriented and self.inputs[3] is not None:
-            self.inputs[0:2] = field_orient(self.inputs[0], self.inputs[1], self.bno055.getHeading())
+            self.inputs[0:2] = field_orient(self.inputs[0], self.inputs[1], heading)
 
         # Are we in setpoint displacement mode?
         if self.distance_pid.isEnable():
@@ -225,7 +414,7 @@ class Chassis:
                             y = -0.3
                     self.distance_pid.disable()
                     self.zero_encoders()
-                    self.distance_pid_heading = constrain_angle(math.atan2(y, x)+self.bno055.getAngle())
+                    self.distance_pid_heading = constrain_angle(math.atan2(y, x)+heading)
                     self.distance_pid.setSetpoint(math.sqrt(x**2+y**2))
                     self.distance_pid.reset()
                     self.distance_pid.enable()
@@ -236,12 +425,16 @@ class Chassis:
             # Keep driving
             self.vx = math.cos(self.distance_pid_heading) * self.distance_pid_output.output
             self.vy = math.sin(self.distance_pid_heading) * self.distance_pid_output.output
+        elif self.profile is not None:
+            output = self.follow_profile()
+            self.vx = math.cos(self.distance_pid_heading) * output
+            self.vy = math.sin(self.distance_pid_heading) * output
         else:
             self.vx = self.inputs[0] * self.inputs[3]  # multiply by throttle
             self.vy = self.inputs[1] * self.inputs[3]  # multiply by throttle
 
         if self.heading_hold:
-            if self.momentum and abs(self.bno055.getHeadingRate()) < 0.005:
+            if self.momentum and abs(self.bno055.reading.heading_rate) < 0.005:
                 self.momentum = False
 
             if self.inputs[2] != 0.0:
@@ -251,10 +444,12 @@ class Chassis:
                 self.heading_hold_pid.enable()
                 self.vz = self.heading_hold_pid_output.output
             else:
-                self.heading_hold_pid.setSetpoint(self.bno055.getAngle())
+                self.heading_hold_pid.setSetpoint(heading)
                 self.vz = self.inputs[2] * self.inputs[3]  # multiply by throttle
 
-        if self.lock_wheels:
+        if onboard:
+            pass
+        elif self.lock_wheels:
             for _, params, module in zip(Chassis.module_params.items(),
                                          self._modules):
                 direction = constrain_angle(math.atan2(params['vz']['y'],
@@ -271,10 +466,10 @@ class Chassis:
         self.heading_hold_pid.setSetpoint(constrain_angle(setpoint))
 
     def on_range_target(self):
-        return abs(self.range_finder.getDistance() - self.range_setpoint) < 0.1
+        return abs(self.range_finder.reading - self.range_setpoint) < 0.1
 
     def on_vision_target(self):
-        return (self.vision.no_vision_counter == 0.0 and
+        return (self.vision.confidence() > 0.5 and
                 abs(self.vision.pidGet()) < 0.035)
 
 
@@ -284,11 +479,13 @@ class SwerveModule():
                  reverse_steer=False, zero_reading=0,
                  drive_encoder=False, reverse_drive_encoder=False):
         # Initialise private motor controllers
-        self._drive = CANTalon(drive)
+        self._drive = CachedTalon(drive)
         self.reverse_drive = reverse_drive
-        self._steer = CANTalon(steer)
+        self._steer = CachedTalon(steer)
         self.drive_encoder = drive_encoder
         self._distance_offset = 0  # Offset the drive distance counts
+        self._odometry_position = self._drive.reading.position
+        self._position_target = self._drive.reading.position
 
         # Set up the motor controllers
         # Different depending on whether we are using absolute encoders or not
@@ -327,12 +524,15 @@ class SwerveModule():
         self._drive.setVoltageRampRate(150.0)
 
     def changeDriveControlMode(self, control_mode):
-        if self._drive.getControlMode is not control_mode:
-            if control_mode == CANTalon.ControlMode.Speed:
-                self._drive.setPID(1.0, 0.00, 0.0, 1023.0 / self.drive_max_speed)
-            elif control_mode == CANTalon.ControlMode.Position:
-                self._drive.setPID(0.1, 0.0, 0.0, 0.0)
-            self._drive.changeControlMode(control_mode)
+        # CachedTalon drops these if nothing has changed, so it is safe
+        # to call every time the module is steered
+        if control_mode == CANTalon.ControlMode.Speed:
+            self._drive.setPID(1.0, 0.00, 0.0, 1023.0 / self.drive_max_speed)
+        elif control_mode == CANTalon.ControlMode.Position:
+            # The integral, only within about 0.2m of the target, stops
+            # the drives stalling just short of it. TODO tune on the robot
+            self._drive.setPID(0.4, 0.002, 0.0, 0.0, izone=300)
+        self._drive.changeControlMode(control_mode)
 
     @property
     def direction(self):
@@ -340,6 +540,15 @@ class SwerveModule():
         setpoint = self._steer.getSetpoint()
         return float(setpoint - self._offset) / self.counts_per_radian
 
+    @property
+    def measured_direction(self):
+        # Where the steer encoder says the module is pointing
+        return float(self._steer.reading.value - self._offset) / self.counts_per_radian
+
+    @property
+    def steer_error(self):
+        return self._steer.getSetpoint() - self._steer.reading.value
+
     @property
     def speed(self):
         # Read the current speed from the controller setpoint
@@ -348,11 +557,37 @@ class SwerveModule():
 
     @property
     def distance(self):
-        # Read the current position from the encoder and remove the offset
-        return self._drive.getEncPosition() - self._distance_offset
+        # Take the position from this loop's reading and remove the offset
+        return self._drive.reading.enc_position - self._distance_offset
 
     def zero_distance(self):
-        self._distance_offset = self._drive.getEncPosition()
+        self._distance_offset = self._drive.reading.enc_position
+
+    def odometry_delta(self):
+        # Metres travelled along measured_direction since the last call.
+        # Use the closed loop position, which has reverse_drive_encoder
+        # applied, rather than the raw encoder count.
+        position = self._drive.reading.position
+        delta = position - self._odometry_position
+        self._odometry_position = position
+        if self.reverse_drive:
+            delta = -delta
+        return delta / self.drive_counts_per_metre
+
+    def drive_to(self, metres):
+        # Drive metres along the current direction using the Talon's
+        # position loop. Use the closed loop sensor position rather than the
+        # raw encoder, as it has reverse_drive_encoder applied.
+        counts = metres * self.drive_counts_per_metre
+        if self.reverse_drive:
+            counts = -counts
+        self.changeDriveControlMode(CANTalon.ControlMode.Position)
+        self._position_target = self._drive.reading.position + counts
+        self._drive.set(self._position_target)
+
+    @property
+    def position_error(self):
+        return self._position_target - self._drive.reading.position
 
     def steer(self, direction, speed=None):
         if self.drive_encoder:
@@ -362,28 +597,30 @@ class SwerveModule():
         # Set the speed and direction of the swerve module
         # Always choose the direction that minimises movement,
         # even if this means reversing the drive motor
+        # Only read the steer setpoint once
+        current_direction = self.direction
         if speed is None:
             # Force the modules to the direction specified - don't
             # go to the closest one and reverse.
-            delta = constrain_angle(direction - self.direction)  # rescale to +/-pi
-            self._steer.set((self.direction + delta) *
+            delta = constrain_angle(direction - current_direction)  # rescale to +/-pi
+            self._steer.set((current_direction + delta) *
                             self.counts_per_radian + self._offset)
             self._drive.set(0.0)
             return
 
         if abs(speed) > 0.05:
             direction = constrain_angle(direction)  # rescale to +/-pi
-            current_heading = constrain_angle(self.direction)
+            current_heading = constrain_angle(current_direction)
 
             delta = min_angular_displacement(current_heading, direction)
 
             if self.reverse_drive:
                 speed = -speed
-            if abs(constrain_angle(self.direction - direction)) < math.pi / 6.0:
+            if abs(constrain_angle(current_direction - direction)) < math.pi / 6.0:
                 self._drive.set(speed*self.drive_max_speed)
             else:
                 self._drive.set(-speed*self.drive_max_speed)
-            self._steer.set((self.direction + delta) *
+            self._steer.set((current_direction + delta) *
                             self.counts_per_radian + self._offset)
         else:
             self._drive.set(0.0)
@@ -13,7 +13,7 @@ class Defeater:
         self.defeater_motor.set(-0.5)
 
     def execute(self):
-        current = self.defeater_motor.getOutputCurrent()
+        current = self.defeater_motor.reading.output_current
 
         if current > 10.0:
             self.defeater_motor.set(0.0)
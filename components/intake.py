@@ -54,18 +54,19 @@ class Intake:
     def up_to_speed(self):
         """ Is the intake up to speed yet? """
         return (self.intake_motor.getSetpoint() == 0.7 * Intake.max_speed
-                and self.intake_motor.getClosedLoopError() < Intake.max_speed * 0.05)
+                and self.intake_motor.reading.closed_loop_error < Intake.max_speed * 0.05)
 
     def ball_detected(self):
-        return (self.intake_motor.getClosedLoopError() > Intake.max_speed * 0.1
+        return (self.intake_motor.reading.closed_loop_error > Intake.max_speed * 0.1
                 and self.acceleration < 0.0 and self.current_rate > 0.0)
 
     def slowing(self):
         return self.velocity < 0.0 and self.acceleration > 0.0
 
     def pinned(self):
-        return (self.intake_motor.getClosedLoopError() < 20
-                and abs(self.intake_motor.get()) > abs(self.intake_motor.getSetpoint()) * 0.5)
+        reading = self.intake_motor.reading
+        return (reading.closed_loop_error < 20
+                and abs(reading.value) > abs(self.intake_motor.getSetpoint()) * 0.5)
 
     def speed_mode(self):
         self.intake_motor.changeControlMode(CANTalon.ControlMode.Speed)
@@ -94,24 +95,25 @@ class Intake:
         self.stop()
 
     def execute(self):
+        reading = self.intake_motor.reading
         # add next reading on right, will automatically pop on left
         maxlen = self.current_deque.maxlen
         prev_current_avg = sum(self.current_deque)/maxlen
-        self.current_deque.append(self.intake_motor.getOutputCurrent())
+        self.current_deque.append(reading.output_current)
         self.current_avg = sum(self.current_deque) / maxlen
         self.current_rate = self.current_avg - prev_current_avg
-        self.velocity = self.intake_motor.get()
+        self.velocity = reading.value
         self.acceleration = self.velocity - self.previous_velocity
 
         self.sd.putDouble("intake_current_rate", self.current_rate)
         self.sd.putDouble("intake_current_avg", self.current_avg)
         self.sd.putDouble("intake_closed_loop_error",
-                          self.intake_motor.getClosedLoopError())
+                          reading.closed_loop_error)
         self.sd.putDouble("intake_acceleration", self.acceleration)
         self.sd.putDouble("intake_velocity", self.velocity)
 
         self.log_queue.append(self.current_deque[maxlen-1])
-        self.velocity_queue.append(self.intake_motor.get())
+        self.velocity_queue.append(self.velocity)
 
         if self.write_log:
             self.log_current()
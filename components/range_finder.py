@@ -10,6 +10,10 @@ class RangeFinder(PIDSource):
         self.range_finder_counter = wpilib.Counter(dio_number)
         self.range_finder_counter.setSemiPeriodMode(highSemiPeriod=True)
         self._smoothed_d = 0.0
+        self.sample()
+
+    def sample(self):
+        self.reading = self.getDistance()
 
     def getDistance(self):
         return self.range_finder_counter.getPeriod() * 1000000 / 1000 # 10 usec is 1cm, return as metres
@@ -19,6 +23,6 @@ class RangeFinder(PIDSource):
 
     def pidGet(self):
         alpha = 0.7
-        d = self.getDistance()
+        d = self.reading
         self._smoothed_d = alpha * d + (1.0 - alpha) * self._smoothed_d
         return self._smoothed_d
@@ -19,9 +19,10 @@ class Shooter:
         self._speed = 0.0
 
     def up_to_speed(self):
-        return (abs(self.shooter_motor.getClosedLoopError()) <= 0.02 * (self.max_speed)
+        reading = self.shooter_motor.reading
+        return (abs(reading.closed_loop_error) <= 0.02 * (self.max_speed)
                 and self.shooter_motor.getSetpoint() != 0.0
-                and abs(self.shooter_motor.get()) > abs(self.shooter_motor.getSetpoint() * 0.5)
+                and abs(reading.value) > abs(self.shooter_motor.getSetpoint() * 0.5)
                 )
 
     def shoot(self):
@@ -0,0 +1,24 @@
+import time
+
+from .talon import CachedTalon
+
+
+class Snapshot:
+    """Reads every sensor once at the start of a control loop iteration.
+
+    Each Talon and sensor keeps what was read in its .reading, so all the
+    components see the robot at the same instant and nothing is read over
+    CAN or I2C more than once per loop. update() must be called first
+    thing in every periodic and autonomous iteration."""
+
+    def __init__(self, *sensors):
+        # Anything other than the Talons with a sample() method
+        self.sensors = sensors
+        self.timestamp = None
+
+    def update(self):
+        self.timestamp = time.time()
+        for talon in CachedTalon.instances:
+            talon.sample()
+        for sensor in self.sensors:
+            sensor.sample()
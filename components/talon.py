@@ -0,0 +1,81 @@
+from wpilib import CANTalon
+
+from collections import namedtuple
+import weakref
+
+
+# The values read back from a Talon by CachedTalon.sample()
+TalonReading = namedtuple('TalonReading', ['value', 'position', 'enc_position',
+                                           'closed_loop_error', 'output_current'])
+
+
+class CachedTalon(CANTalon):
+    """A CANTalon that remembers the last control mode, PID gains and
+    setpoint it was given, and drops writes that would not change them.
+
+    Every component that owns a Talon should create one of these instead
+    of a CANTalon, so repeated mode and gain changes (for example on every
+    SwerveModule.steer call) don't fill the CAN bus.
+
+    It also holds the last values read from the Talon in .reading, which
+    Snapshot.update() refreshes once per control loop."""
+
+    # Totals across every CachedTalon on the robot
+    total_sent = 0
+    total_suppressed = 0
+    # Every CachedTalon, so that the snapshot can sample them all
+    instances = weakref.WeakSet()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = 0
+        self.suppressed = 0
+        self.clear_cache()
+        self.sample()
+        CachedTalon.instances.add(self)
+
+    def sample(self):
+        self.reading = TalonReading(self.get(), self.getPosition(),
+                                    self.getEncPosition(),
+                                    self.getClosedLoopError(),
+                                    self.getOutputCurrent())
+
+    def clear_cache(self):
+        """Forget what has been written, so the next writes all go out.
+        Call this when the Talon may have lost its state (eg while disabled)."""
+        self._cached_mode = None
+        self._cached_pid = None
+        self._cached_setpoint = None
+
+    @classmethod
+    def clear_all_caches(cls):
+        for talon in cls.instances:
+            talon.clear_cache()
+
+    def _count(self, sent):
+        if sent:
+            self.sent += 1
+            CachedTalon.total_sent += 1
+        else:
+            self.suppressed += 1
+            CachedTalon.total_suppressed += 1
+        return sent
+
+    def changeControlMode(self, controlMode):
+        if self._count(controlMode != self._cached_mode):
+            super().changeControlMode(controlMode)
+            self._cached_mode = controlMode
+            # The old setpoint means something else in the new mode
+            self._cached_setpoint = None
+
+    def setPID(self, *args, **kwargs):
+        gains = (args, tuple(sorted(kwargs.items())))
+        if self._count(gains != self._cached_pid):
+            super().setPID(*args, **kwargs)
+            self._cached_pid = gains
+
+    def set(self, *args, **kwargs):
+        setpoint = (args, tuple(sorted(kwargs.items())))
+        if self._count(setpoint != self._cached_setpoint):
+            super().set(*args, **kwargs)
+            self._cached_setpoint = setpoint
@@ -2,8 +2,126 @@ from networktables import NetworkTable
 from wpilib.interfaces import PIDSource
 import hal
 
+from collections import deque
+import math
+import os
+import threading
+import time
+
+from .bno055 import BNO055
+from .snapshot import Snapshot
+
+
+def wrap(angle):
+    return math.atan2(math.sin(angle), math.cos(angle))
+
+
+class BearingFilter:
+    """Constant velocity Kalman filter for the bearing of the target.
+    The state is kept at the capture time of the last measurement, and
+    estimate() predicts it forward to any later time.
+    Measurements come in on the NetworkTables thread while the main loop
+    and the PID threads read estimates, so the state is only touched
+    while holding the lock."""
+
+    def __init__(self, measurement_std, acceleration_std, initial_rate_std,
+                 max_prediction):
+        self.measurement_variance = measurement_std ** 2
+        self.acceleration_variance = acceleration_std ** 2
+        self.initial_rate_variance = initial_rate_std ** 2
+        # Don't extrapolate the rate further than this, in case we
+        # haven't seen the target for a while
+        self.max_prediction = max_prediction
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self.timestamp = None
+        self.bearing = 0.0
+        self.rate = 0.0
+        # Covariance of (bearing, rate)
+        self.p00 = self.p01 = self.p11 = 0.0
+
+    def predict(self, dt):
+        # Returns the state and covariance dt seconds after the last
+        # measurement, with white noise acceleration
+        q = self.acceleration_variance
+        bearing = wrap(self.bearing + self.rate * min(dt, self.max_prediction))
+        p00 = (self.p00 + 2.0 * dt * self.p01 + dt * dt * self.p11 +
+               q * dt ** 3 / 3.0)
+        p01 = self.p01 + dt * self.p11 + q * dt * dt / 2.0
+        p11 = self.p11 + q * dt
+        return bearing, p00, p01, p11
+
+    def update(self, timestamp, bearing):
+        # Returns False if the measurement is no newer than the last one
+        with self.lock:
+            return self._update(timestamp, bearing)
+
+    def _update(self, timestamp, bearing):
+        if self.timestamp is None:
+            self.timestamp = timestamp
+            self.bearing = bearing
+            self.rate = 0.0
+            self.p00 = self.measurement_variance
+            self.p01 = 0.0
+            self.p11 = self.initial_rate_variance
+            return True
+        dt = timestamp - self.timestamp
+        if dt <= 0.0:
+            return False
+        predicted, p00, p01, p11 = self.predict(dt)
+        rate = self.rate
+        error = wrap(bearing - predicted)
+        s = p00 + self.measurement_variance
+        k0 = p00 / s
+        k1 = p01 / s
+        self.timestamp = timestamp
+        self.bearing = wrap(predicted + k0 * error)
+        self.rate = rate + k1 * error
+        self.p00 = (1.0 - k0) * p00
+        self.p01 = (1.0 - k0) * p01
+        self.p11 = p11 - k1 * p01
+        return True
+
+    def estimate(self, timestamp):
+        """Return the (bearing, variance) predicted for timestamp, or
+        None if we have never seen the target."""
+        with self.lock:
+            if self.timestamp is None:
+                return None
+            bearing, variance, _, _ = self.predict(max(timestamp - self.timestamp, 0.0))
+        return bearing, variance
+
 
 class Vision:
+    bno055 = BNO055
+    snapshot = Snapshot
+
+    # Logitech C270 - 55 degree diagonal field of view, so about
+    # 45 degrees horizontally
+    horizontal_fov = math.radians(45.0)
+    # One second of headings at 50Hz is far longer than the vision latency
+    heading_history_length = 50
+    # Tuning for the bearing filter. The measurement error is a pixel or
+    # so, and the target only moves in the field frame when we drive
+    # sideways past it.
+    measurement_std = math.radians(0.5)
+    acceleration_std = math.radians(10.0)  # per second squared
+    initial_rate_std = math.radians(10.0)  # per second
+    max_prediction = 0.5  # seconds
+    # confidence() is 0.5 when the bearing is known to within this
+    target_std = math.radians(1.0)
+    # Results from vision.worker, which are read straight from shared
+    # memory rather than coming over NetworkTables
+    results_path = '/dev/shm/vision_results'
+    # How often to look for the results if the worker isn't running yet
+    results_retry = 1.0  # seconds
+
     def __init__(self):
         # mjpg-streamer isn't setting parameters properly yet, so do it here
         if not hal.HALIsSimulation():  # pragma: no cover
@@ -12,25 +130,148 @@ class Vision:
                                  "/etc/default/mjpg-streamer")
         self.nt = NetworkTable.getTable('vision')
         self._values = {'x': 0.0, 'y': 0.0, 'w': 0.0, 'h': 0.0, 'time': 0.0}
-        self._smoothed_pidget = 0.0
+        # True bearing and elevation from the lens calibration, if the
+        # vision process sends them
+        self.bearing = None
+        self.elevation = None
+        # (time, heading) pairs, oldest first. Results arrive on the
+        # NetworkTables thread, so hold the lock to use it.
+        self.heading_history = deque(maxlen=self.heading_history_length)
+        self.heading_lock = threading.Lock()
+        # Filtered bearing of the target relative to the gyro's zero,
+        # rather than the robot, so that it doesn't change as we turn
+        self.filter = BearingFilter(self.measurement_std, self.acceleration_std,
+                                    self.initial_rate_std, self.max_prediction)
+        # Frames in a row without the target, for the dashboard
         self.no_vision_counter = 0
+        # Sequence number of the last packed result, and how many we missed
+        self.sequence = None
+        self.dropped_results = 0
+        # Once we get packed results, ignore the separate keys
+        self.packed = False
+        self.results = None
+        self.next_results_check = 0.0
         self.nt.addTableListener(self.valueChanged)
 
     def valueChanged(self, table, key, value, isNew):
+        if key == 'result':
+            self.newResult(value)
+            return
         self._values[key] = float(value)
-        if key == 'time':
+        if key == 'time' and not self.packed:
             # The time key is updated last,
-            # so let's update our smoothed average
-            alpha = 0.3
-            if self._values['w'] > 0.0:
-                self._smoothed_pidget = (alpha * self._values['x'] +
-                                         (1.0 - alpha) * self._smoothed_pidget)
-                self.no_vision_counter = 0
+            # so let's update our filtered bearing
+            self.update()
+
+    def newResult(self, value):
+        # The whole result for a frame in one go:
+        # (sequence, time, x, y, w, h[, bearing, elevation])
+        sequence, timestamp, x, y, w, h = value[:6]
+        if sequence == self.sequence:
+            return
+        if self.sequence is not None and sequence > self.sequence + 1:
+            self.dropped_results += int(sequence - self.sequence - 1)
+        self.sequence = sequence
+        self.packed = True
+        self._values.update(x=x, y=y, w=w, h=h, time=timestamp)
+        # Without a calibration the bearing and elevation are NaN
+        self.bearing = self.elevation = None
+        if len(value) >= 8 and math.isfinite(value[6]):
+            self.bearing, self.elevation = value[6:8]
+        self.update()
+
+    def readResults(self):
+        if self.results is None:
+            now = time.time()
+            if now < self.next_results_check:
+                return
+            self.next_results_check = now + self.results_retry
+            if not os.path.exists(self.results_path):
+                return
+            from vision.shared import ResultSlot
+            self.results = ResultSlot.open(self.results_path)
+        result = self.results.read()
+        if result is not None:
+            self.newResult(result)
+
+    def update(self):
+        if self._values['w'] > 0.0:
+            # Add on the heading from when the frame was captured, so
+            # that turning since then isn't mistaken for the target moving
+            if self.bearing is not None:
+                bearing = self.bearing
             else:
-                self.no_vision_counter += 1
+                bearing = self.xToBearing(self._values['x'])
+            bearing += self.headingAt(self._values['time'])
+            self.filter.update(self._values['time'], wrap(bearing))
+            self.no_vision_counter = 0
+        else:
+            self.no_vision_counter += 1
+
+    def xToBearing(self, x):
+        # Convert the normalised x position in the image to an angle.
+        # Anticlockwise is positive, like the gyro, so right is negative.
+        return -math.atan(x * math.tan(self.horizontal_fov / 2.0))
+
+    def bearingToX(self, bearing):
+        return -math.tan(bearing) / math.tan(self.horizontal_fov / 2.0)
+
+    def headingAt(self, timestamp):
+        # Interpolate the heading history to find which way we were
+        # pointing at the given time
+        with self.heading_lock:
+            history = list(self.heading_history)
+        if not history:
+            return 0.0
+        newer_time, newer_heading = history[-1]
+        if timestamp >= newer_time:
+            return newer_heading
+        for older_time, older_heading in reversed(history):
+            if older_time <= timestamp:
+                fraction = (timestamp - older_time) / (newer_time - older_time)
+                return older_heading + fraction * wrap(newer_heading - older_heading)
+            newer_time, newer_heading = older_time, older_heading
+        # Older than anything we remember
+        return newer_heading
+
+    def currentHeading(self):
+        if not self.heading_history:
+            return 0.0
+        return self.heading_history[-1][1]
+
+    def write_image(self):
+        # Ask the vision process to save the next frame. It does the
+        # writing on its own thread, so this never holds up the loop.
+        self.nt.putNumber('record_request', time.time())
 
     def getPIDSourceType(self):  # pragma: no cover
         return PIDSource.PIDSourceType.kDisplacement
 
-    def pidGet(self):
-        return -self._smoothed_pidget
+    def confidence(self, timestamp=None):
+        """How sure we are of where the target is now, from 1 down to 0
+        as the uncertainty grows while we go without seeing it."""
+        estimate = self.filter.estimate(time.time() if timestamp is None else timestamp)
+        if estimate is None:
+            return 0.0
+        return 1.0 / (1.0 + estimate[1] / self.target_std ** 2)
+
+    def pidGet(self, timestamp=None):
+        # The filter predicts where the target is at this moment, so the
+        # control loop gets a fresh value every tick between frames
+        estimate = self.filter.estimate(time.time() if timestamp is None else timestamp)
+        if estimate is None:
+            return 0.0
+        # Where the target is relative to the way we are pointing now
+        return -self.bearingToX(wrap(estimate[0] - self.currentHeading()))
+
+    def execute(self):
+        # Remember which way we were pointing, so that vision results can be
+        # corrected for how far we have turned since the frame was captured
+        # This runs after the snapshot, so use its heading and time. There
+        # is nothing to add if no mode has taken a snapshot yet.
+        if self.snapshot.timestamp is not None:
+            with self.heading_lock:
+                self.heading_history.append((self.snapshot.timestamp,
+                                             self.bno055.reading.heading))
+        # Pick up the latest result if the vision worker is running
+        self.readResults()
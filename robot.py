@@ -12,6 +12,8 @@ from components import shooter
 from components.intake import Intake
 from components.defeater import Defeater
 from components.boulder_automation import BoulderAutomation
+from components.talon import CachedTalon
+from components.snapshot import Snapshot
 
 from networktables import NetworkTable
 
@@ -19,6 +21,7 @@ import logging
 import math
 
 class StrongholdRobot(magicbot.MagicRobot):
+    vision = Vision
     chassis = Chassis
     intake = Intake
     shooter = Shooter
@@ -28,17 +31,18 @@ class StrongholdRobot(magicbot.MagicRobot):
     def createObjects(self):
         self.logger = logging.getLogger("robot")
         self.sd = NetworkTable.getTable('SmartDashboard')
-        self.intake_motor = wpilib.CANTalon(14)
-        self.shooter_motor = wpilib.CANTalon(12)
-        self.defeater_motor = wpilib.CANTalon(1)
+        self.intake_motor = CachedTalon(14)
+        self.shooter_motor = CachedTalon(12)
+        self.defeater_motor = CachedTalon(1)
         self.joystick = wpilib.Joystick(0)
         self.gamepad = wpilib.Joystick(1)
         self.pressed_buttons_js = set()
         self.pressed_buttons_gp = set()
         # needs to be created here so we can pass it in to the PIDController
         self.bno055 = BNO055()
-        self.vision = Vision()
         self.range_finder = RangeFinder(0)
+        # Sampled at the start of every loop, see Snapshot
+        self.snapshot = Snapshot(self.bno055, self.range_finder)
         self.heading_hold_pid_output = BlankPIDOutput()
         Tu = 1.6
         Ku = 0.6
@@ -61,9 +65,11 @@ class StrongholdRobot(magicbot.MagicRobot):
         self.joystick_rate = 0.3
 
     def putData(self):
-        self.sd.putDouble("range_finder", self.range_finder.getDistance())
-        self.sd.putDouble("gyro", self.bno055.getHeading())
+        gyro = self.bno055.reading
+        self.sd.putDouble("range_finder", self.range_finder.reading)
+        self.sd.putDouble("gyro", gyro.heading)
         self.sd.putDouble("vision_pid_get", self.vision.pidGet())
+        self.sd.putDouble("vision_confidence", self.vision.confidence())
         self.sd.putDouble("vision_x", self.vision._values['x'])
         self.sd.putDouble("vision_w", self.vision._values['w'])
         self.sd.putDouble("vision_h", self.vision._values['h'])
@@ -72,9 +78,9 @@ class StrongholdRobot(magicbot.MagicRobot):
         self.sd.putDouble("vz", self.chassis.vz)
         self.sd.putDouble("input_twist", self.chassis.inputs[2])
         self.sd.putDouble("field_oriented", self.chassis.field_oriented)
-        self.sd.putDouble("raw_yaw", self.bno055.getRawHeading())
-        self.sd.putDouble("raw_pitch", self.bno055.getPitch())
-        self.sd.putDouble("raw_roll", self.bno055.getRoll())
+        self.sd.putDouble("raw_yaw", gyro.raw_heading)
+        self.sd.putDouble("raw_pitch", gyro.pitch)
+        self.sd.putDouble("raw_roll", gyro.roll)
         self.sd.putDouble("shooter_speed", -self.shooter.shooter_motor.getSetpoint()) # minus sign here so +ve is shooting
         self.sd.putDouble("heading_pid_output", self.heading_hold_pid_output.output)
         self.sd.putDouble("heading_hold_pid_setpoint", self.heading_hold_pid.getSetpoint())
@@ -83,13 +89,17 @@ class StrongholdRobot(magicbot.MagicRobot):
         self.sd.putDouble("distance_pid_output", self.chassis.distance_pid_output.output)
         self.sd.putBoolean("track_vision", self.chassis.track_vision)
         self.sd.putDouble("pov", self.joystick.getPOV())
-        self.sd.putDouble("gyro_z_rate", self.bno055.getHeadingRate())
-        self.sd.putDouble("heading_hold_error", self.heading_hold_pid.getSetpoint()-self.bno055.getAngle())
-        self.sd.putDouble("defeater_current", self.defeater_motor.getOutputCurrent())
-        self.sd.putDouble("defeater_speed", self.defeater_motor.get())
+        self.sd.putDouble("gyro_z_rate", gyro.heading_rate)
+        self.sd.putDouble("heading_hold_error", self.heading_hold_pid.getSetpoint()-gyro.heading)
+        self.sd.putDouble("defeater_current", self.defeater_motor.reading.output_current)
+        self.sd.putDouble("defeater_speed", self.defeater_motor.reading.value)
         self.sd.putDouble("joystick_throttle", self.joystick.getThrottle())
         self.sd.putDouble("range_pid_get", self.range_finder.pidGet())
         self.sd.putDouble("encoder_distance", self.chassis.distance)
+        self.sd.putDouble("odometry_x", self.chassis.odometry_x)
+        self.sd.putDouble("odometry_y", self.chassis.odometry_y)
+        self.sd.putDouble("can_frames_sent", CachedTalon.total_sent)
+        self.sd.putDouble("can_frames_suppressed", CachedTalon.total_suppressed)
         distances = []
         for module in self.chassis._modules.values():
             distances.append(abs(module.distance) / module.drive_counts_per_metre)
@@ -101,7 +111,11 @@ class StrongholdRobot(magicbot.MagicRobot):
 
     def disabledPeriodic(self):
         """This function is called periodically when disabled."""
+        self.snapshot.update()
         self.putData()
+        # A Talon may be reset while we are disabled, so send everything
+        # again once we are enabled
+        CachedTalon.clear_all_caches()
 
     def teleopInit(self):
         self.boulder_automation.done()
@@ -111,6 +125,7 @@ class StrongholdRobot(magicbot.MagicRobot):
 
     def teleopPeriodic(self):
         """This function is called periodically during operator control."""
+        self.snapshot.update()
 
         try:
             if self.debounce(6, gamepad=True):
@@ -268,6 +283,7 @@ class StrongholdRobot(magicbot.MagicRobot):
             if input != 0.0:
                 # Break out of auto if we move the stick
                 self.chassis.distance_pid.disable()
+                self.chassis.cancel_displacement()
                 self.chassis.range_setpoint = None
                 self.chassis.track_vision = False
                 #self.chassis.field_oriented = True
@@ -0,0 +1,57 @@
+import unittest
+
+try:
+    from vision import batch
+    import numpy as np
+
+    def test_load_samples():
+        samples = batch.loadSamples('sample_img/tests.csv')
+        assert len(samples) == 4
+        assert samples[0][0].endswith('test0.png')
+        assert samples[0][1] == (0.17, -0.525, 0.3, 0.145)
+        # A directory has no labels
+        samples = batch.loadSamples('sample_img')
+        assert len(samples) == 4
+        assert all(label is None for _, label in samples)
+
+    def test_image_cache(tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        image = batch.loadImage('sample_img/test0.png')
+        cached = batch.loadImage('sample_img/test0.png', cache_dir)
+        assert (cached == image).all()
+        # Second time around should come from the memory mapped file
+        cached = batch.loadImage('sample_img/test0.png', cache_dir)
+        assert isinstance(cached, np.memmap)
+        assert (cached == image).all()
+
+    def test_evaluate(tmpdir):
+        report = batch.evaluate('sample_img/tests.csv', repeats=2, workers=1,
+                                cache_dir=str(tmpdir))
+        summary = report['summary']
+        assert summary['images'] == 4
+        assert summary['passed'] == summary['labelled'] == 4
+        assert summary['latency']['frames'] == 8
+        assert (summary['latency']['p50_ms'] <= summary['latency']['p95_ms']
+                <= summary['latency']['p99_ms'])
+        assert len(report['results'][0]['times']) == 2
+
+    def test_evaluate_process_pool():
+        report = batch.evaluate('sample_img/tests.csv', workers=2)
+        assert report['summary']['passed'] == 4
+
+    def test_evaluate_lookup_table():
+        report = batch.evaluate('sample_img/tests.csv', workers=1, threshold='lut')
+        assert report['summary']['labelled'] == 4
+        assert report['summary']['threshold'] == 'lut'
+        assert max(report['summary']['max_errors']) < 0.02
+
+    def test_benchmark_thresholds():
+        report = batch.benchmarkThresholds('sample_img/tests.csv', repeats=2)
+        assert report['latency']['hsv']['frames'] == 8
+        assert report['latency']['lut']['frames'] == 8
+        assert report['mask_agreement']['min'] > 0.99
+
+except ImportError as e:
+    @unittest.skip('Missing dependency - ' + str(e))
+    def test_fail():
+        pass
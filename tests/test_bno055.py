@@ -20,3 +20,11 @@ def test_reset_heading():
     bno055.resetHeading(2.0)
     heading = bno055.getHeading()
     assert heading == 2.0
+
+def test_sample():
+    bno055 = BNO055()
+    bno055.resetHeading(1.0)
+    assert abs(bno055.reading.heading - 1.0) < epsilon
+    bno055.sample()
+    assert abs(bno055.reading.heading - bno055.getHeading()) < epsilon
+    assert abs(bno055.reading.pitch - BNO055Sim.pitch) < epsilon
@@ -0,0 +1,49 @@
+import unittest
+
+try:
+    from vision import calibrate
+    import cv2
+    import numpy as np
+    import pytest
+
+    def render_chessboard(camera_matrix, rvec, tvec, size=(320, 240), square=40,
+                          pattern=(9, 6)):
+        # Draw a flat chessboard as seen by a perfect camera, with its
+        # first inside corner at the origin and one unit per square
+        columns, rows = pattern[0] + 1, pattern[1] + 1
+        board = np.full(((rows + 2) * square, (columns + 2) * square), 255, np.uint8)
+        for row in range(rows):
+            for column in range(columns):
+                if (row + column) % 2 == 0:
+                    board[(row + 1) * square:(row + 2) * square,
+                          (column + 1) * square:(column + 2) * square] = 0
+        rotation, _ = cv2.Rodrigues(np.array(rvec, np.float64))
+        to_board = np.array([[1.0 / square, 0.0, -2.0], [0.0, 1.0 / square, -2.0],
+                             [0.0, 0.0, 1.0]])
+        homography = camera_matrix.dot(np.column_stack(
+            (rotation[:, 0], rotation[:, 1], np.array(tvec, np.float64)))).dot(to_board)
+        return cv2.warpPerspective(board, homography, size, borderValue=255)
+
+    def test_calibrate(tmpdir):
+        camera_matrix = np.array([[300.0, 0.0, 160.0], [0.0, 300.0, 120.0],
+                                  [0.0, 0.0, 1.0]])
+        poses = [((0.3, 0.0, 0.0), (-4, -3, 18)), ((0.0, 0.3, 0.0), (-4, -3, 18)),
+                 ((-0.3, 0.2, 0.1), (-4, -2, 17)), ((0.2, -0.3, 0.0), (-5, -3, 19)),
+                 ((0.0, 0.0, 0.2), (-4, -3, 16))]
+        filenames = []
+        for i, (rvec, tvec) in enumerate(poses):
+            filenames.append(str(tmpdir.join('%d.png' % i)))
+            cv2.imwrite(filenames[-1], render_chessboard(camera_matrix, rvec, tvec))
+        calibration, error = calibrate.calibrate(filenames)
+        assert error < 1.0
+        assert calibration.resolution == (320, 240)
+        assert abs(calibration.camera_matrix[0, 0] - 300.0) < 15.0
+        assert abs(calibration.camera_matrix[1, 1] - 300.0) < 15.0
+        # Not enough views of the board
+        with pytest.raises(ValueError):
+            calibrate.calibrate(filenames[:2])
+
+except ImportError as e:
+    @unittest.skip("Vision module not available")
+    def test_fail():
+        pass
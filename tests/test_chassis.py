@@ -1,11 +1,12 @@
 
 import math
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from components.chassis import SwerveModule
-from components.chassis import Chassis, constrain_angle, field_orient
+from components.chassis import Chassis, TrapezoidalProfile, constrain_angle, field_orient
 from components import chassis
+from components.bno055 import GyroReading
 
 epsilon = 0.01  # Tolerance for floating point errors (~0.5 degrees)
 
@@ -154,6 +155,19 @@ def test_toggle_track_vision():
     chassis.toggle_vision_tracking()
     assert chassis.track_vision is vision
 
+def test_on_vision_target():
+    chassis = Chassis()
+    chassis.vision = MagicMock()
+    chassis.vision.pidGet.return_value = 0.01
+    chassis.vision.confidence.return_value = 0.9
+    assert chassis.on_vision_target()
+    # Lined up, but we haven't seen it for too long to be sure
+    chassis.vision.confidence.return_value = 0.1
+    assert not chassis.on_vision_target()
+    chassis.vision.confidence.return_value = 0.9
+    chassis.vision.pidGet.return_value = -0.1
+    assert not chassis.on_vision_target()
+
 def test_toggle_range_holding():
     chassis = Chassis()
     chassis.distance_pid = MagicMock()
@@ -172,3 +186,158 @@ def test_field_orient_calc():
     assert abs(vy - 0.0) < epsilon
 
 
+
+def test_drive_matches_module_params():
+    # The precomputed module_vz rows must give the same commands as working
+    # each module out from its module_params entry
+    chassis = Chassis()
+    for module in chassis._modules.values():
+        module.steer = MagicMock()
+    for vx, vy, vz in [(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.3, -0.7, 0.0),
+                       (0.0, 0.0, -1.0), (1.0, 1.0, 1.0), (-0.2, 0.5, 0.4)]:
+        chassis.drive(vx, vy, vz)
+        vectors = {name: (vx + vz * params['vz']['x'], vy + vz * params['vz']['y'])
+                   for name, params in Chassis.module_params.items()}
+        max_mag = max([1.0] + [math.hypot(x, y) for x, y in vectors.values()])
+        for name, (x, y) in vectors.items():
+            direction, speed = chassis._modules[name].steer.call_args[0]
+            assert abs(direction - math.atan2(y, x)) < 1e-9
+            assert abs(speed - math.hypot(x, y) / max_mag) < 1e-9
+
+def test_odometry():
+    chassis = Chassis()
+    chassis.bno055 = MagicMock()
+    chassis.bno055.reading = GyroReading(0.0, 0.0, 0.0, 0.0, 0.0)
+    chassis.reset_odometry(1.0, 2.0)
+
+    def move(metres, direction):
+        # Point every module in direction and drive them all forward
+        for module in chassis._modules.values():
+            counts = metres * module.drive_counts_per_metre
+            if module.reverse_drive:
+                counts = -counts
+            module._drive.reading = module._drive.reading._replace(
+                position=module._drive.reading.position + counts)
+            module._steer.reading = module._steer.reading._replace(
+                value=direction * module.counts_per_radian + module._offset)
+        chassis.update_odometry()
+
+    move(1.0, 0.0)
+    assert abs(chassis.odometry_x - 2.0) < epsilon
+    assert abs(chassis.odometry_y - 2.0) < epsilon
+    # The raw encoder counts aren't reversed like the closed loop
+    # position, so they play no part
+    for module in chassis._modules.values():
+        module._drive.reading = module._drive.reading._replace(
+            enc_position=module._drive.reading.enc_position + 1000)
+    chassis.update_odometry()
+    assert abs(chassis.odometry_x - 2.0) < epsilon
+    # Zeroing the encoders for the distance PID doesn't move us
+    chassis.zero_encoders()
+    chassis.update_odometry()
+    assert abs(chassis.odometry_x - 2.0) < epsilon
+    # Facing along the field y axis, robot x is field y
+    chassis.bno055.reading = GyroReading(math.pi / 2.0, 0.0, 0.0, 0.0, 0.0)
+    chassis.reset_odometry()
+    move(0.5, 0.0)
+    assert abs(chassis.odometry_x) < epsilon
+    assert abs(chassis.odometry_y - 0.5) < epsilon
+    move(0.5, math.pi / 2.0)
+    assert abs(chassis.odometry_x - -0.5) < epsilon
+    assert abs(chassis.odometry_y - 0.5) < epsilon
+
+def test_trapezoidal_profile():
+    # Long enough to reach full speed: 0.5s to speed, 1.5s cruising
+    profile = TrapezoidalProfile(3.0, 1.5, 3.0)
+    assert abs(profile.duration - 2.5) < epsilon
+    assert profile.sample(0.0) == (0.0, 0.0)
+    position, velocity = profile.sample(0.5)
+    assert abs(position - 0.375) < epsilon and abs(velocity - 1.5) < epsilon
+    position, velocity = profile.sample(1.25)
+    assert abs(position - 1.5) < epsilon and abs(velocity - 1.5) < epsilon
+    assert profile.sample(2.5) == (3.0, 0.0)
+    # Too short to reach full speed
+    profile = TrapezoidalProfile(0.12, 1.5, 3.0)
+    assert abs(profile.peak_speed - 0.6) < epsilon
+    assert abs(profile.duration - 0.4) < epsilon
+    position, velocity = profile.sample(0.3)
+    assert abs(position - (0.12 - 1.5 * 0.1 ** 2)) < epsilon
+    assert abs(velocity - 0.3) < epsilon
+    # Not moving at all
+    assert TrapezoidalProfile(0.0, 1.5, 3.0).duration == 0.0
+
+def test_profiled_field_displace():
+    chassis = Chassis()
+    chassis.bno055 = MagicMock()
+    chassis.bno055.reading = GyroReading(0.0, 0.0, 0.0, 0.0, 0.0)
+    chassis.distance_pid = MagicMock()
+    duration = chassis.field_displace(1.0, 0.0, profiled=True)
+    assert abs(duration - chassis.profile.duration) < epsilon
+    assert not chassis.distance_pid.enable.called
+    assert not chassis.on_profile_target()
+    # Right at the start we are only pushed by the correction term
+    assert chassis.follow_profile() >= 0.0
+    chassis.cancel_displacement()
+    assert chassis.on_profile_target()
+
+def test_onboard_field_displace():
+    chassis = Chassis()
+    chassis.bno055 = MagicMock()
+    chassis.bno055.reading = GyroReading(0.0, 0.0, 0.0, 0.0, 0.0)
+    chassis.distance_pid = MagicMock()
+    chassis.heading_hold_pid = MagicMock()
+    chassis.heading_hold_pid.getSetpoint.return_value = 0.0
+    chassis.field_displace(0.0, 1.0, onboard=True)
+    assert not chassis.on_onboard_target()
+    assert not chassis.distance_pid.enable.called
+
+    def snapshot():
+        # Pretend the Talons have done what they were told
+        for module in chassis._module_list:
+            module._steer.reading = module._steer.reading._replace(
+                value=module._steer.getSetpoint())
+            module._drive.reading = module._drive.reading._replace(
+                position=module._position_target)
+
+    # The drives don't start until the modules point the right way
+    assert chassis.update_onboard_displacement()
+    assert not chassis.onboard_started
+    snapshot()
+    assert chassis.update_onboard_displacement()
+    assert chassis.onboard_started
+    for module in chassis._module_list:
+        assert abs(module.direction - chassis.distance_pid_heading) < epsilon
+        assert abs(abs(module.position_error) - module.drive_counts_per_metre) < epsilon
+    snapshot()
+    assert not chassis.update_onboard_displacement()
+    assert chassis.on_onboard_target()
+
+
+def test_onboard_fallback():
+    chassis = Chassis()
+    chassis.bno055 = MagicMock()
+    chassis.bno055.reading = GyroReading(0.0, 0.0, 0.0, 0.0, 0.0)
+    chassis.distance_pid = MagicMock()
+    chassis.heading_hold_pid = MagicMock()
+    chassis.heading_hold_pid.getSetpoint.return_value = 0.0
+    with patch('components.chassis.Timer') as timer:
+        timer.getFPGATimestamp.return_value = 10.0
+        chassis.field_displace(1.0, 0.0, onboard=True)
+        # The drives never get there, so the distance PID takes over
+        timer.getFPGATimestamp.return_value = 10.0 + chassis.onboard_timeout + 1.0 / chassis.onboard_min_speed + 0.1
+        assert not chassis.update_onboard_displacement()
+    chassis.distance_pid.setSetpoint.assert_called_with(1.0)
+    assert chassis.distance_pid.enable.called
+    chassis.distance_pid.onTarget.return_value = False
+    assert not chassis.on_onboard_target()
+    chassis.distance_pid.onTarget.return_value = True
+    assert chassis.on_onboard_target()
+
+    # Heading hold can't turn us while the Talons drive, so hand over if
+    # the heading wanders off
+    chassis.distance_pid = MagicMock()
+    chassis.field_displace(1.0, 0.0, onboard=True)
+    chassis.onboard_started = True
+    chassis.heading_hold_pid.getSetpoint.return_value = 0.2
+    assert not chassis.update_onboard_displacement()
+    assert chassis.distance_pid.enable.called
@@ -11,3 +11,13 @@ def test_range_finder_syntax():
     rf.range_finder_counter = MagicMock()
     pid_value = rf.pidGet()
     dist = rf.getDistance()
+
+def test_pid_get_uses_reading():
+    rf = RangeFinder(0)
+    rf.range_finder_counter = MagicMock()
+    rf.range_finder_counter.getPeriod.return_value = 0.002
+    rf.sample()
+    rf.range_finder_counter.getPeriod.reset_mock()
+    # Smoothing the reading doesn't read the sensor again
+    assert abs(rf.pidGet() - 0.7 * 2.0) < 1e-6
+    assert not rf.range_finder_counter.getPeriod.called
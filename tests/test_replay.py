@@ -0,0 +1,89 @@
+import time
+import unittest
+
+try:
+    from vision import replay, vision
+    import cv2
+    import numpy as np
+
+    def test_directory_source():
+        frames = list(replay.directorySource('sample_img', fps=10.0))
+        assert len(frames) == 4
+        assert [timestamp for timestamp, _ in frames] == [0.0, 0.1, 0.2, 0.3]
+        assert (frames[0][1]() == cv2.imread('sample_img/test0.png')).all()
+
+    def test_recorded_directory_source(tmpdir):
+        image = cv2.imread('sample_img/test0.png', cv2.IMREAD_COLOR)
+        recorder = vision.FrameRecorder(str(tmpdir))
+        recorder.record(100.25, image, image)
+        recorder.record(100.0, image, image)
+        recorder.close()
+        # Recorded frames keep their capture times, and the annotated
+        # copies are left out
+        frames = list(replay.openSource(str(tmpdir)))
+        assert [timestamp for timestamp, _ in frames] == [100.0, 100.25]
+
+    def test_video_source(tmpdir):
+        filename = str(tmpdir.join('test.avi'))
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'),
+                                 10.0, (64, 48))
+        if not writer.isOpened():
+            return
+        for i in range(5):
+            writer.write(np.full((48, 64, 3), i * 50, np.uint8))
+        writer.release()
+        frames = list((timestamp, read()) for timestamp, read in replay.openSource(filename))
+        assert len(frames) == 5
+        assert abs(frames[4][0] - 0.4) < 1e-6
+        assert frames[4][1].shape == (48, 64, 3)
+
+    def test_replay_fast():
+        results = []
+
+        def process(image, capture_time):
+            results.append(vision.findTarget(image, annotate=False)[:4])
+            return image
+        report = replay.replay(replay.openSource('sample_img'), process=process)
+        assert report['frames'] == report['processed'] == 4
+        assert report['dropped'] == 0
+        assert report['stages']['detect']['frames'] == 4
+        assert 'show' not in report['stages']
+        assert results[0] == vision.findTarget(
+            cv2.imread('sample_img/test0.png'), annotate=False)[:4]
+        # The default is the tracked pipeline, like on the robot
+        report = replay.replay(replay.openSource('sample_img'))
+        assert report['processed'] == 4
+
+    def test_replay_profiled():
+        profiler = vision.StageProfiler()
+        report = replay.replay(replay.openSource('sample_img'), profiler=profiler)
+        assert report['pipeline']['total']['p50_ms'] > 0.0
+        assert 'morphology' in report['pipeline']
+
+    def test_replay_recorded():
+        source = replay.directorySource('sample_img', fps=20.0)
+        report = replay.replay(source, 'recorded', lambda image, t: image)
+        assert report['processed'] == 4
+        # Four frames 0.05s apart takes at least 0.15s to play
+        assert report['elapsed_s'] >= 0.15
+
+    def test_replay_drops_late_frames():
+        source = replay.directorySource('sample_img', fps=100.0)
+        capture_times = []
+
+        def slowProcess(image, capture_time):
+            capture_times.append(capture_time)
+            time.sleep(0.025)
+            return image
+        report = replay.replay(source, 'recorded', slowProcess)
+        # Processing takes 2.5 frames, so every other frame has been
+        # replaced by a newer one by the time we are ready for it
+        assert report['dropped'] >= 1
+        assert report['processed'] + report['dropped'] == 4
+        # Capture times are spaced like the recording
+        assert capture_times[-1] - capture_times[0] >= 0.015
+
+except ImportError as e:
+    @unittest.skip("Vision module not available")
+    def test_fail():
+        pass
@@ -0,0 +1,183 @@
+import multiprocessing
+import time
+import unittest
+
+from components.bno055 import GyroReading
+from components.snapshot import Snapshot
+from components.vision import Vision
+
+try:
+    from vision import shared, vision, worker
+    import cv2
+    import numpy as np
+
+    def synthetic_frame(centre=(100, 50), size=(40, 16), shape=(120, 160, 3)):
+        # A U of green tape on a dark background
+        image = np.full(shape, 20, np.uint8)
+        x, y = centre[0] - size[0] // 2, centre[1] - size[1] // 2
+        colour = (0, 140, 0)
+        cv2.rectangle(image, (x, y), (x + 3, y + size[1]), colour, -1)
+        cv2.rectangle(image, (x + size[0] - 3, y), (x + size[0], y + size[1]), colour, -1)
+        cv2.rectangle(image, (x, y + size[1] - 3), (x + size[0], y + size[1]), colour, -1)
+        return image
+
+    def test_frame_ring(tmpdir):
+        path = str(tmpdir.join('frames'))
+        writer = shared.FrameRing.create(path, (120, 160, 3), slots=3)
+        reader = shared.FrameRing.open(path)
+        assert reader.shape == (120, 160, 3)
+        assert reader.get(timeout=0.01) is None
+        frame = writer.reserve()
+        frame[:] = synthetic_frame()
+        assert reader.get(timeout=0.01) is None  # Not committed yet
+        assert writer.commit(1.5) == 1
+        view, timestamp, sequence = reader.get(timeout=0.01)
+        assert (timestamp, sequence) == (1.5, 1)
+        assert np.array_equal(view, synthetic_frame())
+        # The reader sees the writer's memory, not a copy of it
+        frame[0, 0] = 255
+        assert (view[0, 0] == 255).all()
+        # Only the newest frame is returned
+        writer.put(synthetic_frame((50, 50)), 2.0)
+        writer.put(synthetic_frame((60, 50)), 3.0)
+        view, timestamp, sequence = reader.get(sequence, timeout=0.01)
+        assert (timestamp, sequence) == (3.0, 3)
+        assert reader.valid(3)
+        # Once the writer laps the ring the frame is no longer valid
+        for i in range(3):
+            writer.put(synthetic_frame(), 4.0 + i)
+        assert not reader.valid(3)
+        with open(str(tmpdir.join('other')), 'wb') as f:
+            f.write(b'\0' * 64)
+        try:
+            shared.FrameRing.open(str(tmpdir.join('other')))
+            assert False, "Opened something that isn't a ring"
+        except ValueError:
+            pass
+
+    def test_result_slot(tmpdir):
+        path = str(tmpdir.join('results'))
+        writer = shared.ResultSlot.create(path)
+        reader = shared.ResultSlot.open(path)
+        assert reader.read() is None
+        writer.write((1, 100.0, 0.25, 0.1, 0.5, 0.2, -0.2, 0.05))
+        assert reader.read() == (1, 100.0, 0.25, 0.1, 0.5, 0.2, -0.2, 0.05)
+        # Halfway through a write the reader gives up rather than
+        # returning a mixture
+        writer._counter += 1
+        shared.struct.pack_into('<Q', writer._mm, 0, writer._counter)
+        assert reader.read(retries=3) is None
+
+    def test_worker(tmpdir):
+        ring = shared.FrameRing.create(str(tmpdir.join('frames')), (120, 160, 3))
+        results = shared.ResultSlot.create(str(tmpdir.join('results')))
+        vision_worker = worker.VisionWorker(ring, results)
+        assert not vision_worker.step(timeout=0.01)
+        image = synthetic_frame((100, 50))
+        ring.put(image, 10.0)
+        assert vision_worker.step(timeout=0.01)
+        sequence, timestamp, x, y, w, h, bearing, elevation = results.read()
+        assert (sequence, timestamp) == (1, 10.0)
+        assert abs(x - (100.0 / 80.0 - 1.0)) < 0.05
+        assert abs(w - 40.0 / 160.0) < 0.05
+        # Same as searching the frame directly, and nothing was drawn on it
+        assert (x, y, w, h) == vision.findTarget(image.copy(), annotate=False)[:4]
+        assert np.array_equal(ring.frames[1], image)
+        ring.put(synthetic_frame(), 11.0)
+        ring.put(synthetic_frame(), 12.0)
+        vision_worker.step(timeout=0.01)
+        assert vision_worker.dropped == 1
+        assert results.read()[:2] == (3, 12.0)
+
+    def test_worker_ring_recreated(tmpdir):
+        path = str(tmpdir.join('frames'))
+        ring = shared.FrameRing.create(path, (120, 160, 3))
+        results = shared.ResultSlot.create(str(tmpdir.join('results')))
+        vision_worker = worker.VisionWorker(ring, results)
+        for i in range(6):
+            ring.put(synthetic_frame(), 10.0 + i)
+        assert vision_worker.step(timeout=0.01)
+        assert vision_worker.sequence == 6
+        # The capture restarts and creates the ring over the old one
+        new_ring = shared.FrameRing.create(path, (120, 160, 3))
+        assert ring.latest == 0
+        assert new_ring.get(timeout=0.01) is None
+        new_ring.put(synthetic_frame((100, 50)), 20.0)
+        # The worker picks up the new frames rather than waiting for
+        # the old count to be passed
+        assert vision_worker.step(timeout=0.01)
+        assert results.read()[:2] == (1, 20.0)
+        assert vision_worker.dropped == 0
+
+    def run_worker(frames_path, results_path, stop):
+        ring = shared.FrameRing.open(frames_path)
+        results = shared.ResultSlot.open(results_path)
+        worker.VisionWorker(ring, results).run(stop, timeout=0.01)
+
+    def test_worker_process(tmpdir):
+        frames_path = str(tmpdir.join('frames'))
+        results_path = str(tmpdir.join('results'))
+        ring = shared.FrameRing.create(frames_path, (120, 160, 3))
+        results = shared.ResultSlot.create(results_path)
+        stop = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_worker,
+                                          args=(frames_path, results_path, stop))
+        process.start()
+        try:
+            for i, x in enumerate((40, 80, 120)):
+                sequence = ring.put(synthetic_frame((x, 60)), 20.0 + i)
+                deadline = time.time() + 5.0
+                while time.time() < deadline:
+                    result = results.read()
+                    if result is not None and result[0] == sequence:
+                        break
+                    time.sleep(0.001)
+                assert result[0] == sequence
+                assert abs(result[2] - (x / 80.0 - 1.0)) < 0.05
+        finally:
+            stop.set()
+            process.join(5.0)
+        assert process.exitcode == 0
+
+    def test_vision_reads_uncalibrated_worker(tmpdir):
+        class Gyro:
+            reading = GyroReading(0.0, 0.0, 0.0, 0.0, 0.0)
+        ring = shared.FrameRing.create(str(tmpdir.join('frames')), (120, 160, 3))
+        results = shared.ResultSlot.create(str(tmpdir.join('results')))
+        ring.put(synthetic_frame((120, 50)), time.time())
+        assert worker.VisionWorker(ring, results).step(timeout=0.01)
+        x = results.read()[2]
+        v = Vision()
+        v.bno055 = Gyro()
+        v.snapshot = Snapshot()
+        v.snapshot.update()
+        v.results_path = str(tmpdir.join('results'))
+        v.execute()
+        # Without a calibration the bearing comes from x, not 0.0
+        assert v.bearing is None
+        assert abs(v.pidGet() - -x) < 1e-3
+        assert abs(v.pidGet()) > 0.1
+
+    def test_vision_reads_shared_results(tmpdir):
+        class Gyro:
+            reading = GyroReading(0.0, 0.0, 0.0, 0.0, 0.0)
+        writer = shared.ResultSlot.create(str(tmpdir.join('results')))
+        v = Vision()
+        v.bno055 = Gyro()
+        v.snapshot = Snapshot()
+        v.snapshot.update()
+        v.results_path = str(tmpdir.join('results'))
+        v.execute()
+        assert v.pidGet() == 0.0
+        writer.write((1, time.time(), 0.25, 0.1, 0.5, 0.2, v.xToBearing(0.25), 0.0))
+        v.execute()
+        assert v.sequence == 1
+        assert abs(v.pidGet() - -0.25) < 1e-3
+        # Reading the same result again changes nothing
+        v.execute()
+        assert v.no_vision_counter == 0
+
+except ImportError as e:
+    @unittest.skip("Vision module not available")
+    def test_fail():
+        pass
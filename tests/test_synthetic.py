@@ -0,0 +1,53 @@
+import math
+import os
+import unittest
+
+try:
+    from vision import batch, synthetic
+    import cv2
+    import numpy as np
+
+    def test_ground_truth():
+        # Square on in the middle of the frame
+        outline = synthetic.projectGoal((640, 480), 100.0, 0.0, 0.0)
+        x, y, w, h = synthetic.groundTruth(outline, (640, 480))
+        focal_length = 320.0 / math.tan(math.radians(22.5))
+        assert abs(x) < 1e-6 and abs(y) < 1e-6
+        assert abs(w - 20.0 * focal_length / 100.0 / 640.0) < 1e-3
+        assert abs(h - 14.0 * focal_length / 100.0 / 480.0) < 1e-3
+        # Placed where we asked for it
+        outline = synthetic.projectGoal((640, 480), 100.0, 0.5, -0.25, yaw=0.3,
+                                        pitch=0.7)
+        x, y, w, h = synthetic.groundTruth(outline, (640, 480))
+        assert abs(x - 0.5) < 0.02 and abs(y - -0.25) < 0.02
+
+    def test_generate(tmpdir):
+        for resolution in ((160, 120), (640, 480), (1280, 720)):
+            directory = str(tmpdir.join('%dx%d' % resolution))
+            filename = synthetic.generate(directory, 5, resolution, seed=1)
+            samples = batch.loadSamples(filename)
+            assert len(samples) == 5
+            for path, label in samples:
+                image = cv2.imread(path)
+                assert image.shape == (resolution[1], resolution[0], 3)
+                assert all(-1.0 < value < 1.0 for value in label[:2])
+                assert all(0.0 < value < 1.0 for value in label[2:])
+        # The same seed gives the same frames
+        again = synthetic.generate(str(tmpdir.join('again')), 5, (640, 480), seed=1)
+        with open(again) as f, open(os.path.join(str(tmpdir.join('640x480')),
+                                                 'tests.csv')) as g:
+            assert f.read() == g.read()
+        assert np.array_equal(cv2.imread(str(tmpdir.join('again', 'synthetic0.png'))),
+                              cv2.imread(str(tmpdir.join('640x480', 'synthetic0.png'))))
+
+    def test_evaluate_synthetic(tmpdir):
+        filename = synthetic.generate(str(tmpdir), 20, (640, 480), seed=2)
+        summary = batch.evaluate(filename, workers=1)['summary']
+        assert summary['labelled'] == 20
+        assert summary['passed'] >= 18
+        assert max(summary['max_errors'][:2]) < 0.05
+
+except ImportError as e:
+    @unittest.skip("Vision module not available")
+    def test_fail():
+        pass
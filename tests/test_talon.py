@@ -0,0 +1,61 @@
+from wpilib import CANTalon
+
+from components.snapshot import Snapshot
+from components.talon import CachedTalon
+
+
+def test_suppress_repeated_writes():
+    talon = CachedTalon(0)
+    talon.changeControlMode(CANTalon.ControlMode.Speed)
+    talon.setPID(1.0, 0.0, 0.0, 1.8)
+    talon.set(100.0)
+    assert talon.sent == 3 and talon.suppressed == 0
+    talon.changeControlMode(CANTalon.ControlMode.Speed)
+    talon.setPID(1.0, 0.0, 0.0, 1.8)
+    talon.set(100.0)
+    assert talon.sent == 3 and talon.suppressed == 3
+    assert talon.getSetpoint() == 100.0
+
+    # New values still go out
+    talon.set(200.0)
+    talon.setPID(1.0, 0.0, 0.0, 2.0)
+    assert talon.sent == 5
+    assert talon.getSetpoint() == 200.0
+
+
+def test_mode_change_resends_setpoint():
+    talon = CachedTalon(0)
+    talon.changeControlMode(CANTalon.ControlMode.Speed)
+    talon.set(0.0)
+    talon.changeControlMode(CANTalon.ControlMode.Position)
+    talon.set(0.0)
+    assert talon.suppressed == 0
+
+
+def test_clear_cache():
+    talon = CachedTalon(0)
+    sent = CachedTalon.total_sent
+    talon.set(0.5)
+    talon.clear_cache()
+    talon.set(0.5)
+    assert talon.sent == 2 and talon.suppressed == 0
+    assert CachedTalon.total_sent == sent + 2
+
+
+def test_snapshot(hal_data):
+    talon = CachedTalon(0)
+    hal_data['CAN'][0]['enc_position'] = 1234
+    # The reading only changes when the snapshot is taken
+    assert talon.reading.enc_position != 1234
+    Snapshot().update()
+    assert talon.reading.enc_position == 1234
+
+
+def test_clear_all_caches():
+    talons = [CachedTalon(0), CachedTalon(1)]
+    for talon in talons:
+        talon.set(0.5)
+    CachedTalon.clear_all_caches()
+    for talon in talons:
+        talon.set(0.5)
+        assert talon.sent == 2 and talon.suppressed == 0
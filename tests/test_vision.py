@@ -1,5 +1,12 @@
+import math
+import os
+import threading
+import time
 import unittest
+from unittest import mock
 from networktables import NetworkTable
+from components.bno055 import GyroReading
+from components.snapshot import Snapshot
 from components.vision import Vision
 
 def find_target(filename, result, desired, deltas):
@@ -13,6 +20,7 @@ try:
     from vision import vision
     import cv2
     import csv
+    import numpy as np
 
     def test_sample_images():
         variables = ['x', 'y', 'w', 'h']
@@ -25,6 +33,461 @@ try:
                 results = vision.findTarget(image)
                 yield find_target, sample[0], results[:-1], sample[1:], [0.05, 0.05]  # Don't send the return image
 
+    def test_pipeline_sample_images():
+        pipeline = vision.VisionPipeline()
+        with open('sample_img/tests.csv', 'r') as csvfile:
+            testreader = csv.reader(csvfile, delimiter=',')
+            for sample in testreader:
+                image = cv2.imread('sample_img/' + sample[0])
+                expected = vision.findTarget(image.copy())
+                results = pipeline.findTarget(image.copy())
+                assert results[:-1] == expected[:-1]
+                assert (results[-1] == expected[-1]).all()
+        # Only one set of buffers for the one resolution
+        assert len(pipeline._buffers) == 1
+
+    def test_pipeline_reuses_buffers():
+        pipeline = vision.VisionPipeline()
+        image = cv2.imread('sample_img/test0.png')
+        hsv, mask, erosion, dilated, labels = pipeline.buffers(image.shape)
+        pipeline.findTarget(image.copy())
+        assert pipeline.buffers(image.shape)[0] is hsv
+        # OpenCV should have written the results into our buffers
+        expected = cv2.inRange(cv2.cvtColor(image, cv2.COLOR_BGR2HSV),
+                               vision.LOWER_COLOUR, vision.UPPER_COLOUR)
+        assert (mask == expected).all()
+        # Including when only part of the frame is searched
+        mask[:] = 0
+        pipeline.findTarget(image.copy(), (10, 10, 50, 50))
+        assert (mask[10:50, 10:50] == expected[10:50, 10:50]).all()
+        assert not mask[50:].any()
+
+    def test_headless():
+        image = cv2.imread('sample_img/test0.png')
+        original = image.copy()
+        expected = vision.findTarget(image.copy())
+        results = vision.findTarget(image, annotate=False)
+        assert results[:-1] == expected[:-1]
+        # Nothing should have been drawn
+        assert (results[-1] == original).all()
+        results = vision.VisionPipeline(annotate=False).findTarget(image)
+        assert results[:-1] == expected[:-1]
+        assert (results[-1] == original).all()
+
+    def test_lookup_table_threshold():
+        lookup_table = vision.ColourLookupTable()
+        pipeline = vision.VisionPipeline(lookup_table=lookup_table)
+        with open('sample_img/tests.csv', 'r') as csvfile:
+            testreader = csv.reader(csvfile, delimiter=',')
+            for sample in testreader:
+                image = cv2.imread('sample_img/' + sample[0])
+                expected = cv2.inRange(cv2.cvtColor(image, cv2.COLOR_BGR2HSV),
+                                       vision.LOWER_COLOUR, vision.UPPER_COLOUR)
+                mask = lookup_table.threshold(image)
+                # Should only differ at the edges of the colour bounds
+                assert (mask == expected).mean() > 0.99
+                # and the target should move by less than a pixel or so
+                results = pipeline.findTarget(image.copy())
+                expected = vision.findTarget(image.copy())
+                for result, value in zip(results[:-1], expected[:-1]):
+                    assert abs(result - value) < 0.01
+
+    def test_coarse_to_fine():
+        with open('sample_img/tests.csv', 'r') as csvfile:
+            testreader = csv.reader(csvfile, delimiter=',')
+            for sample in testreader:
+                image = cv2.imread('sample_img/' + sample[0])
+                pipeline = vision.VisionPipeline(downscale=2)
+                results = pipeline.findTarget(image.copy())
+                yield find_target, sample[0], results[:-1], sample[1:], [0.05, 0.05]
+                # Pretend we have a higher resolution camera. Should get the
+                # same answer as searching the whole frame
+                image = cv2.resize(image, (image.shape[1] * 4, image.shape[0] * 4),
+                                   interpolation=cv2.INTER_NEAREST)
+                pipeline = vision.VisionPipeline(downscale=4)
+                results = pipeline.findTarget(image.copy())
+                assert results[:-1] == vision.findTarget(image.copy())[:-1]
+                # Only the area around the target is searched at full resolution
+                x0, y0, x1, y1 = pipeline.coarseWindow(image)
+                assert (x1 - x0) * (y1 - y0) < image.shape[0] * image.shape[1] / 4
+
+    def test_scored_candidates():
+        pipeline = vision.VisionPipeline(score_candidates=True)
+        with open('sample_img/tests.csv', 'r') as csvfile:
+            testreader = csv.reader(csvfile, delimiter=',')
+            for sample in testreader:
+                image = cv2.imread('sample_img/' + sample[0])
+                results = pipeline.findTarget(image.copy())
+                assert results[:-1] == vision.findTarget(image.copy())[:-1]
+                assert len(pipeline.candidates) >= 1
+                # Sprinkle a lot of noise around, and a blob of the right
+                # colour that is bigger than the goal but the wrong shape
+                noisy = image.copy()
+                colour = cv2.cvtColor(np.uint8([[[75, 200, 100]]]), cv2.COLOR_HSV2BGR)[0, 0]
+                for i in range(100):
+                    x = (i * 37) % (image.shape[1] - 6)
+                    y = image.shape[0] - 30 + (i * 11) % 25
+                    noisy[y:y + 6, x:x + 6] = colour
+                noisy[5:40, 5:45] = colour
+                results = pipeline.findTarget(noisy)
+                yield find_target, sample[0], results[:-1], sample[1:], [0.05, 0.05]
+                scores = [score for score, _ in pipeline.candidates]
+                assert scores == sorted(scores, reverse=True)
+
+    def test_rank_candidates():
+        #                  left top width height area
+        stats = np.array([[0, 0, 100, 40, 1200],  # The goal
+                          [0, 0, 60, 60, 3600],  # Bigger, but a solid square
+                          [0, 0, 2, 2, 4],  # Noise
+                          [0, 0, 25, 10, 75]])  # A small goal
+        ranked, scores = vision.rankCandidates(stats, 320 * 240)
+        assert list(ranked) == [0, 3, 1]
+        assert scores[2] == 0.0
+
+    def test_tracked_sample_images():
+        with open('sample_img/tests.csv', 'r') as csvfile:
+            testreader = csv.reader(csvfile, delimiter=',')
+            for sample in testreader:
+                tracker = vision.TargetTracker()
+                image = cv2.imread('sample_img/' + sample[0])
+                # First frame searches everything
+                results = tracker.findTarget(image.copy())
+                assert tracker.tracked_frames == 0
+                assert tracker.bounds is not None
+                # and subsequent frames only search around the target
+                results = tracker.findTarget(image.copy())
+                assert tracker.tracked_frames == 1
+                yield find_target, sample[0], results[:-1], sample[1:], [0.05, 0.05]
+
+    def test_tracker_lost_target():
+        tracker = vision.TargetTracker(max_tracked_frames=2)
+        image = cv2.imread('sample_img/test0.png')
+        tracker.findTarget(image.copy())
+        tracker.findTarget(image.copy())
+        tracker.findTarget(image.copy())
+        assert tracker.tracked_frames == 2
+        tracker.findTarget(image.copy())
+        # Should have gone back to a full frame search
+        assert tracker.tracked_frames == 0
+        # Point the window somewhere empty - should find it again anyway
+        x, y, w, h, _ = vision.findTarget(image.copy())
+        tracker.bounds = (0, 0, 4, 4)
+        results = tracker.findTarget(image.copy())
+        assert results[:-1] == (x, y, w, h)
+        assert tracker.tracked_frames == 0
+
+    def test_latest_frame_buffer():
+        frames = vision.LatestFrameBuffer()
+        assert frames.get(timeout=0.01) is None
+        frames.put('a', 1.0)
+        frames.put('b', 2.0)
+        # The newest frame wins
+        assert frames.get() == ('b', 2.0, 2)
+        assert frames.dropped == 1
+        # and it can only be read once
+        assert frames.get(timeout=0.01) is None
+        frames.put('c', 3.0)
+        frames.close()
+        assert frames.get() == ('c', 3.0, 3)
+        assert frames.get() is None
+
+    def test_frame_recorder(tmpdir):
+        directory = str(tmpdir.join('frames'))
+        image = cv2.imread('sample_img/test1.png', cv2.IMREAD_COLOR)
+        recorder = vision.FrameRecorder(directory)
+        assert recorder.record(100.5, image, image)
+        assert recorder.record(101.5, image)
+        recorder.close()
+        assert recorder.written == 2
+        assert sorted(os.listdir(directory)) == ['100.500000_annotated.png',
+                                                 '100.500000_raw.png',
+                                                 '101.500000_raw.png']
+        saved = cv2.imread(os.path.join(directory, '100.500000_raw.png'),
+                           cv2.IMREAD_COLOR)
+        assert np.array_equal(saved, image)
+        # With room for about one frame, only the newest is kept - and
+        # the files from before count against the budget too
+        size = os.path.getsize(os.path.join(directory, '101.500000_raw.png'))
+        recorder = vision.FrameRecorder(directory, max_bytes=size + 1)
+        recorder.record(102.5, image)
+        recorder.close()
+        assert os.listdir(directory) == ['102.500000_raw.png']
+
+    def test_frame_recorder_bad_directory(tmpdir):
+        # A file in the way of the directory doesn't stop it starting
+        blocked = tmpdir.join('blocked')
+        blocked.write('')
+        image = np.zeros((8, 8, 3), np.uint8)
+        recorder = vision.FrameRecorder(str(blocked.join('frames')))
+        assert recorder.record(1.0, image)
+        recorder.close()
+        assert recorder.written == 0
+        # and the directory is only made once there is something to save
+        directory = tmpdir.join('frames')
+        recorder = vision.FrameRecorder(str(directory))
+        assert not directory.exists()
+        recorder.record(2.0, image)
+        recorder.close()
+        assert directory.listdir() == [directory.join('2.000000_raw.png')]
+
+    def test_frame_recorder_drops(tmpdir):
+        recorder = vision.FrameRecorder(str(tmpdir), queue_size=1)
+        # Hold up the writer so the queue fills
+        started = threading.Event()
+        release = threading.Event()
+        write = recorder._write
+
+        def slowWrite(name, image):
+            started.set()
+            release.wait()
+            write(name, image)
+        recorder._write = slowWrite
+        image = np.zeros((8, 8, 3), np.uint8)
+        assert recorder.record(1.0, image)
+        started.wait()
+        assert recorder.record(2.0, image)
+        # The writer is busy and the queue is full, so this doesn't wait
+        assert not recorder.record(3.0, image)
+        assert recorder.dropped == 1
+        release.set()
+        recorder.close()
+        assert recorder.written == 2
+
+    def test_stage_profiler():
+        now = [0.0]
+        profiler = vision.StageProfiler(window=10, clock=lambda: now[0])
+        for i in range(10):
+            profiler.start()
+            now[0] += 0.001
+            profiler.mark('a')
+            now[0] += 0.01 if i < 9 else 0.1
+            profiler.mark('b')
+            profiler.stop()
+        assert profiler.stages() == ['a', 'b', 'total']
+        assert abs(profiler.percentile('a', 50) - 0.001) < 0.0002
+        assert abs(profiler.percentile('b', 50) - 0.01) < 0.002
+        # The slowest frame only shows up at the top
+        assert abs(profiler.percentile('b', 99) - 0.1) < 0.02
+        # and drops out once it is more than window frames ago
+        for i in range(10):
+            profiler.add('b', 0.01)
+        assert abs(profiler.percentile('b', 99) - 0.01) < 0.002
+        assert profiler.percentile('c', 50) is None
+        assert set(profiler.summary()['total']) == {'p50_ms', 'p95_ms', 'p99_ms'}
+
+    def test_profiled_pipeline():
+        profiler = vision.StageProfiler()
+        pipeline = vision.VisionPipeline(annotate=False, profiler=profiler)
+        image = cv2.imread('sample_img/test0.png', cv2.IMREAD_COLOR)
+        result = pipeline.findTarget(image)[:4]
+        assert result == vision.findTarget(image, annotate=False)[:4]
+        assert set(profiler.stages()) == {'cvtColor', 'threshold', 'morphology',
+                                         'contours', 'minAreaRect', 'total'}
+        # The stages add up to the total
+        summary = profiler.summary((50,))
+        assert (sum(summary[stage]['p50_ms'] for stage in summary if stage != 'total')
+                < 1.2 * summary['total']['p50_ms'])
+
+    def test_read_capture_config():
+        config = vision.readCaptureConfig(
+            '../vision/mjpg-streamer',
+            device='/dev/v4l/by-id/usb-046d_0825_96EBCE50-video-index0')
+        assert config == {'index': 2, 'fps': 30.0, 'resolution': (160, 120),
+                          'exposure': 5}
+        # The filter finds its own camera from the script it was given
+        config = vision.readCaptureConfig('../vision/mjpg-streamer',
+                                          script='/home/lvuser/py/vision/vision.py')
+        assert config['index'] == 2
+        config = vision.readCaptureConfig(
+            '../vision/mjpg-streamer',
+            device='/dev/v4l/by-id/usb-046d_0819_3357FC00-video-index0')
+        assert config == {'index': 1, 'fps': 10.0, 'resolution': (160, 120)}
+        assert vision.readCaptureConfig('../vision/mjpg-streamer',
+                                        device='/dev/video5') == {}
+
+    def test_frame_governor():
+        governor = vision.FrameGovernor(0.02, hold_frames=2)
+        assert governor.mode() == "1x downscale, 1 in 1 frames"
+        # Slow frames step it up a level, but only once it has settled
+        assert not governor.update(0.05)
+        assert not governor.update(0.05)
+        assert governor.update(0.05)
+        assert governor.downscale == 2
+        for _ in range(2):
+            governor.update(0.05)
+        assert governor.update(0.05)
+        assert governor.downscale == 4
+        # At the top levels frames are skipped
+        for _ in range(2):
+            governor.update(0.05)
+        assert governor.update(0.05)
+        assert governor.frame_interval == 2
+        assert [governor.skip() for _ in range(4)] == [True, False, True, False]
+        assert governor.skipped == 2
+        # Comfortably under budget steps back down
+        for _ in range(2):
+            governor.update(0.001)
+        assert governor.update(0.001)
+        assert governor.level == 2
+        # Small frames aren't shrunk as far, but can still skip frames
+        governor = vision.FrameGovernor(0.02, max_downscale=2)
+        assert governor.levels == [(1, 1), (2, 1), (2, 2), (2, 3)]
+
+    def test_nt_wrapper():
+        image = cv2.imread('sample_img/test0.png', cv2.IMREAD_COLOR)
+        with mock.patch.object(vision, 'NetworkTable') as nt_class:
+            nt = nt_class.getTable.return_value
+            ntw = vision.NTWrapper(annotate=False,
+                                   governor=vision.FrameGovernor(0.02))
+            # The mode is a string, so it goes in a subtable
+            assert not nt.putString.called
+            assert nt.getSubTable.return_value.putString.called
+            ntw.findTargetNetworkTables(image, 100.0)
+            ntw.findTargetNetworkTables(image, 100.1)
+        sequence, capture_time = nt.putNumberArray.call_args[0][1][:2]
+        assert (sequence, capture_time) == (2, 100.1)
+
+    def test_pipeline_set_downscale():
+        image = cv2.imread('sample_img/test0.png', cv2.IMREAD_COLOR)
+        pipeline = vision.VisionPipeline(annotate=False, downscale=2)
+        expected = pipeline.findTarget(image)[:4]
+        pipeline.setDownscale(1)
+        pipeline.findTarget(image)
+        pipeline.setDownscale(2)
+        assert pipeline.findTarget(image)[:4] == expected
+
+    def test_pinhole_calibration(tmpdir):
+        fov = math.radians(45.0)
+        calibration = vision.CameraCalibration.pinhole(fov, cache_dir=str(tmpdir))
+        # A perfect lens agrees with the robot's conversion from x
+        v = Vision()
+        for x in (-0.9, -0.3, 0.0, 0.45, 1.0):
+            bearing, elevation = calibration.angles(x, 0.0, 160, 120)
+            assert abs(bearing - v.xToBearing(x)) < 1e-4
+            assert abs(elevation) < 1e-4
+        # Up is positive
+        assert calibration.angles(0.0, -0.5, 160, 120)[1] > 0.0
+        # Other resolutions are just scaled
+        assert abs(calibration.angles(0.45, 0.0, 320, 240)[0] - v.xToBearing(0.45)) < 1e-4
+
+    def test_calibration_tables(tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        camera_matrix = [[140.0, 0.0, 81.0], [0.0, 140.0, 59.0], [0.0, 0.0, 1.0]]
+        dist_coeffs = [-0.3, 0.1, 0.0, 0.0, 0.0]
+        calibration = vision.CameraCalibration(camera_matrix, dist_coeffs, (160, 120),
+                                               cache_dir)
+        bearing, elevation = calibration.angles(0.8, -0.6, 160, 120)
+        # Same as undistorting the point itself
+        point = np.array([[[(0.8 + 1.0) * 80.0, (-0.6 + 1.0) * 60.0]]])
+        x, y = cv2.undistortPoints(point, np.array(camera_matrix),
+                                   np.array(dist_coeffs))[0, 0]
+        assert abs(bearing - -math.atan(x)) < 1e-3
+        assert abs(elevation - -math.atan2(y, math.sqrt(1.0 + x * x))) < 1e-3
+        # Barrel distortion squashes the edges, so the linear x is wrong
+        assert abs(bearing - -math.atan(0.8 * 80.0 / 140.0)) > 0.01
+        # The tables were cached, and a new calibration loads them
+        assert len(os.listdir(cache_dir)) == 1
+        calibration.save(str(tmpdir.join('calibration.json')))
+        loaded = vision.CameraCalibration.load(str(tmpdir.join('calibration.json')),
+                                               cache_dir)
+        loaded._computeTables = None
+        assert loaded.angles(0.8, -0.6, 160, 120) == (bearing, elevation)
+        # Undistorting straightens the image out to the same size
+        image = cv2.imread('sample_img/test0.png', cv2.IMREAD_COLOR)
+        undistorted = calibration.undistort(image)
+        assert undistorted.shape == image.shape
+
+    def test_calibration_bad_cache(tmpdir):
+        fov = math.radians(45.0)
+        expected = vision.CameraCalibration.pinhole(fov).angles(0.5, 0.5, 160, 120)
+        # The cache can't be written, so the tables are only kept in memory
+        blocked = tmpdir.join('blocked')
+        blocked.write('')
+        calibration = vision.CameraCalibration.pinhole(fov, cache_dir=str(blocked))
+        assert calibration.angles(0.5, 0.5, 160, 120) == expected
+        # A corrupt cache is worked out again and replaced
+        cache_dir = tmpdir.join('cache')
+        vision.CameraCalibration.pinhole(fov, cache_dir=str(cache_dir)).tables(160, 120)
+        cached, = cache_dir.listdir()
+        cached.write('not an npz')
+        calibration = vision.CameraCalibration.pinhole(fov, cache_dir=str(cache_dir))
+        assert calibration.angles(0.5, 0.5, 160, 120) == expected
+        with np.load(str(cached)) as data:
+            assert data['bearing'].shape == (120, 160)
+
+    def test_parallel_pipeline():
+        single = vision.VisionPipeline(annotate=False, score_candidates=True)
+        hypotheses = ((vision.LOWER_COLOUR, vision.UPPER_COLOUR),)
+        for bands in (1, 3):
+            pipeline = vision.ParallelPipeline(annotate=False, hypotheses=hypotheses,
+                                               bands=bands, workers=2)
+            tracker = vision.TargetTracker(vision.ParallelPipeline(
+                annotate=False, hypotheses=hypotheses, bands=bands, workers=2))
+            for i in range(4):
+                image = cv2.imread('sample_img/test%d.png' % i, cv2.IMREAD_COLOR)
+                expected = single.findTarget(image)[:4]
+                # Splitting into bands gives exactly the same answer
+                assert pipeline.findTarget(image)[:4] == expected
+                assert pipeline.candidates == single.candidates
+                # and so does searching a window of it
+                tracker.reset()
+                for _ in range(2):
+                    assert tracker.findTarget(image)[:4] == expected
+                assert tracker.tracked_frames == 1
+            pipeline.close()
+
+    def test_parallel_hypotheses():
+        # A range that finds nothing loses to one that finds the target
+        nothing = (np.array([0, 0, 0]), np.array([0, 0, 0]))
+        pipeline = vision.ParallelPipeline(
+            annotate=False, hypotheses=(nothing, (vision.LOWER_COLOUR, vision.UPPER_COLOUR)))
+        image = cv2.imread('sample_img/test1.png', cv2.IMREAD_COLOR)
+        expected = vision.VisionPipeline(annotate=False, score_candidates=True).findTarget(image)
+        assert pipeline.findTarget(image)[:4] == expected[:4]
+        assert pipeline.hypothesis == 1
+        pipeline.close()
+        pipeline = vision.ParallelPipeline(annotate=False, hypotheses=(nothing,))
+        assert pipeline.findTarget(image)[:4] == (0.0, 0.0, 0.0, 0.0)
+        assert pipeline.hypothesis is None
+        # The annotation is drawn once, for the winner
+        annotated = vision.ParallelPipeline().findTarget(image.copy())[4]
+        assert not np.array_equal(annotated, image)
+        pipeline.close()
+
+    def test_threaded_pipeline():
+        import threading
+
+        class FakeCapture:
+            def __init__(self, image, count):
+                self.image = image
+                self.count = count
+
+            def read(self):
+                if self.count == 0:
+                    return False, None
+                self.count -= 1
+                return True, self.image.copy()
+
+        processed = []
+
+        def process(image, capture_time):
+            processed.append(capture_time)
+            return image
+
+        image = cv2.imread('sample_img/test0.png')
+        frames = vision.LatestFrameBuffer()
+        results = vision.LatestFrameBuffer()
+        capture = threading.Thread(target=vision.captureFrames,
+                                   args=(FakeCapture(image, 10), frames, threading.Event()))
+        capture.start()
+        vision.processFrames(frames, process, results)
+        capture.join()
+        # Some frames may have been dropped, but never processed twice or out of order
+        assert 0 < len(processed) <= 10
+        assert processed == sorted(set(processed))
+        assert len(processed) + frames.dropped == 10
+        assert results.closed
+
 except ImportError as e:
     @unittest.skip('Missing dependency - ' + str(e))
     def test_fail():
@@ -46,3 +509,187 @@ def test_nt_update():
     nt.putNumber('time', 1235)
     assert v.pidGet() != 0.0
     assert v.no_vision_counter == 0
+
+
+def test_heading_interpolation():
+    v = Vision()
+    assert v.headingAt(10.0) == 0.0
+    v.heading_history.extend([(10.0, 0.0), (10.02, 0.2), (10.04, 0.4)])
+    assert abs(v.headingAt(10.01) - 0.1) < 1e-6
+    assert abs(v.headingAt(10.03) - 0.3) < 1e-6
+    # Outside the history just use the closest end
+    assert v.headingAt(9.0) == 0.0
+    assert v.headingAt(11.0) == 0.4
+    # Wrapping around from pi to -pi shouldn't go the long way around
+    v.heading_history.extend([(11.0, math.pi - 0.1), (11.02, -math.pi + 0.1)])
+    assert abs(abs(v.headingAt(11.01)) - math.pi) < 1e-6
+
+
+def test_latency_compensation():
+    v = Vision()
+    k = math.tan(v.horizontal_fov / 2.0)
+    v.heading_history.extend([(100.0, 0.0), (100.05, 0.1)])
+    # Target dead ahead in a frame captured before we turned 0.1 rad to the left
+    v.valueChanged(None, 'x', 0.0, False)
+    v.valueChanged(None, 'w', 0.5, False)
+    v.valueChanged(None, 'time', 100.0, False)
+    # So it should now be 0.1 rad to our right (x is +ve, pidGet is -x)
+    assert abs(v.pidGet() - math.tan(-0.1) / k) < 1e-6
+    # A frame taken now agrees with that, so nothing should change
+    v.valueChanged(None, 'x', math.tan(0.1) / k, False)
+    v.valueChanged(None, 'time', 100.05, False)
+    assert abs(v.pidGet() - math.tan(-0.1) / k) < 1e-6
+    # Without turning, pidGet is just -x
+    v = Vision()
+    v.valueChanged(None, 'x', 0.25, False)
+    v.valueChanged(None, 'w', 0.5, False)
+    v.valueChanged(None, 'time', 100.0, False)
+    assert abs(v.pidGet() - -0.25) < 1e-6
+
+
+def test_packed_result():
+    v = Vision()
+    #                              seq  time   x     y    w    h
+    v.valueChanged(None, 'result', (1, 100.0, 0.25, 0.1, 0.5, 0.2), True)
+    assert abs(v.pidGet() - -0.25) < 1e-6
+    assert v._values['h'] == 0.2
+    assert v.no_vision_counter == 0
+    # Repeats of the same frame are ignored
+    v.valueChanged(None, 'result', (1, 100.0, 0.0, 0.0, 0.0, 0.0), False)
+    assert v.no_vision_counter == 0
+    v.valueChanged(None, 'result', (4, 100.1, 0.0, 0.0, 0.0, 0.0), False)
+    assert v.no_vision_counter == 1
+    assert v.dropped_results == 2
+    # The separate keys are only for dashboards now
+    v.valueChanged(None, 'time', 100.2, False)
+    assert v.no_vision_counter == 1
+
+
+def test_write_image():
+    v = Vision()
+    v.write_image()
+    first = v.nt.getNumber('record_request', 0.0)
+    assert first > 0.0
+    time.sleep(0.01)
+    # Each call is a new request
+    v.write_image()
+    assert v.nt.getNumber('record_request', 0.0) > first
+
+
+def test_bearing_filter_tracks_moving_target():
+    v = Vision()
+    k = math.tan(v.horizontal_fov / 2.0)
+    v.heading_history.append((0.0, 0.0))
+    # Target moving across at 0.2 rad/s, seen at 30 fps
+    for i in range(30):
+        t = i / 30.0
+        v.valueChanged(None, 'result', (i, t, -math.tan(0.2 * t) / k, 0.0, 0.1, 0.1), True)
+    assert abs(v.filter.rate - 0.2) < 0.01
+    # Between frames it is predicted forward rather than held
+    t = 29 / 30.0 + 0.02
+    assert abs(-math.atan(-v.pidGet(t) * k) - 0.2 * t) < 0.001
+    # A frame no newer than the last is ignored
+    assert not v.filter.update(0.5, 1.0)
+
+
+def test_vision_confidence():
+    v = Vision()
+    assert v.confidence(100.0) == 0.0
+    for i in range(10):
+        v.valueChanged(None, 'result', (i, 100.0 + i / 30.0, 0.1, 0.0, 0.1, 0.1), True)
+    last = 100.0 + 9 / 30.0
+    assert v.confidence(last + 0.1) > 0.5
+    # It fades away if we stop seeing the target
+    assert v.confidence(last + 0.5) < v.confidence(last + 0.1)
+    assert v.confidence(last + 2.0) < 0.5
+    # Frames without the target don't change the estimate
+    bearing = v.filter.bearing
+    v.valueChanged(None, 'result', (10, last + 0.1, 0.0, 0.0, 0.0, 0.0), True)
+    assert v.filter.bearing == bearing
+    assert v.no_vision_counter == 1
+
+
+def test_calibrated_bearing():
+    v = Vision()
+    # The true bearing is used rather than the one worked out from x
+    v.valueChanged(None, 'result', (1, 100.0, 0.5, 0.1, 0.2, 0.1, -0.25, 0.05), True)
+    assert v.bearing == -0.25
+    assert abs(v.filter.bearing - -0.25) < 1e-6
+    assert abs(v.pidGet(100.0) - -v.bearingToX(-0.25)) < 1e-6
+
+
+def test_uncalibrated_bearing():
+    v = Vision()
+    v.valueChanged(None, 'result', (1, 100.0, 0.5, 0.1, 0.2, 0.1, -0.25, 0.05), True)
+    # Without a calibration the bearing is NaN, so it comes from x instead
+    nan = float('nan')
+    v.valueChanged(None, 'result', (2, 100.1, 0.25, 0.1, 0.2, 0.1, nan, nan), True)
+    assert v.bearing is None
+    assert abs(v.filter.bearing - -0.25) > 0.05
+    v = Vision()
+    v.valueChanged(None, 'result', (1, 100.0, 0.25, 0.1, 0.2, 0.1, nan, nan), True)
+    assert abs(v.filter.bearing - v.xToBearing(0.25)) < 1e-6
+
+
+def test_heading_history_threads():
+    # Results are handled on the NetworkTables thread while the main loop
+    # adds to the history
+    v = Vision()
+    stop = threading.Event()
+    errors = []
+
+    def listener():
+        try:
+            while not stop.is_set():
+                v.headingAt(0.5)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=listener)
+    thread.start()
+    for i in range(20000):
+        with v.heading_lock:
+            v.heading_history.append((float(i), 0.0))
+    stop.set()
+    thread.join()
+    assert not errors
+
+
+def test_bearing_filter_threads():
+    # Estimates are read while measurements arrive on another thread,
+    # and must never mix old and new state
+    v = Vision()
+    f = v.filter
+    f.update(0.0, 0.0)
+    stop = threading.Event()
+
+    def measure():
+        t = 0.0
+        while not stop.is_set():
+            t += 0.01
+            f.update(t, 0.1 * t)
+    thread = threading.Thread(target=measure)
+    thread.start()
+    try:
+        for _ in range(20000):
+            with f.lock:
+                before = (f.timestamp, f.bearing, f.p00)
+            assert f.estimate(before[0]) is not None
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_execute_before_snapshot():
+    class Gyro:
+        reading = GyroReading(0.5, 0.5, 0.0, 0.0, 0.0)
+    v = Vision()
+    v.bno055 = Gyro()
+    v.snapshot = Snapshot()
+    v.results_path = '/nonexistent/vision_results'
+    # Nothing is recorded until a snapshot has been taken
+    v.execute()
+    assert not v.heading_history
+    assert v.headingAt(1.0) == 0.0
+    v.snapshot.update()
+    v.execute()
+    assert v.headingAt(v.snapshot.timestamp) == 0.5
@@ -0,0 +1,216 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from vision.vision import (ColourLookupTable, VisionPipeline,
+                           LOWER_COLOUR, UPPER_COLOUR)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+THRESHOLDS = ('hsv', 'lut')
+
+# Each worker process keeps its own pipelines so the buffers get reused
+_pipelines = {}
+
+
+def getPipeline(threshold='hsv', downscale=1, score_candidates=False):
+    key = (threshold, downscale, score_candidates)
+    try:
+        return _pipelines[key]
+    except KeyError:
+        lookup_table = ColourLookupTable() if threshold == 'lut' else None
+        pipeline = VisionPipeline(annotate=False, lookup_table=lookup_table,
+                                  downscale=downscale,
+                                  score_candidates=score_candidates)
+        _pipelines[key] = pipeline
+        return pipeline
+
+
+def loadSamples(path):
+    """Return a list of (filename, label) where label is the expected
+    (x, y, w, h) or None. path is either a directory of images or a csv
+    file in the same format as tests/sample_img/tests.csv."""
+    if os.path.isdir(path):
+        return [(filename, None) for filename in sorted(glob.glob(os.path.join(path, '*')))
+                if filename.lower().endswith(IMAGE_EXTENSIONS)]
+    samples = []
+    directory = os.path.dirname(path)
+    with open(path, 'r') as csvfile:
+        # filename, x, y, w, h
+        for row in csv.reader(csvfile, delimiter=','):
+            if not row:
+                continue
+            samples.append((os.path.join(directory, row[0]),
+                            tuple(float(value) for value in row[1:5])))
+    return samples
+
+
+def loadImage(filename, cache_dir=None):
+    """Read an image, caching the decoded pixels as a .npy file so that
+    the next run can memory map it instead of decoding it again."""
+    if cache_dir is None:
+        return cv2.imread(filename, cv2.IMREAD_COLOR)
+    # Key the cache on the file's path, size and modification time, so
+    # changing the image invalidates it
+    stat = os.stat(filename)
+    key = hashlib.sha1(("%s:%d:%d" % (os.path.abspath(filename), stat.st_size,
+                                      stat.st_mtime_ns)).encode()).hexdigest()
+    cached = os.path.join(cache_dir, key + '.npy')
+    if not os.path.exists(cached):
+        image = cv2.imread(filename, cv2.IMREAD_COLOR)
+        if image is None:
+            return None
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename so other workers never see a partial file
+        partial = cached + '.%d.tmp' % os.getpid()
+        with open(partial, 'wb') as f:
+            np.save(f, image)
+        os.replace(partial, cached)
+    return np.load(cached, mmap_mode='r')
+
+
+def evaluateSample(sample, repeats=1, cache_dir=None, threshold='hsv',
+                   downscale=1, score_candidates=False):
+    pipeline = getPipeline(threshold, downscale, score_candidates)
+    filename, label = sample
+    image = loadImage(filename, cache_dir)
+    if image is None:
+        return {'file': filename, 'error': 'Could not read image'}
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        x, y, w, h, _ = pipeline.findTarget(image)
+        times.append(time.perf_counter() - start)
+    result = {'file': filename, 'result': [x, y, w, h], 'times': times}
+    if label is not None:
+        # Same tolerances as the unit tests - absolute for position,
+        # relative for size
+        errors = [abs(x - label[0]), abs(y - label[1]),
+                  abs(w - label[2]), abs(h - label[3])]
+        result['label'] = list(label)
+        result['errors'] = errors
+        result['passed'] = (errors[0] < 0.05 and errors[1] < 0.05 and
+                            errors[2] < 0.05 * label[2] and errors[3] < 0.05 * label[3])
+    return result
+
+
+def _evaluate(args):
+    return evaluateSample(*args)
+
+
+def percentiles(times):
+    if not times:
+        return {}
+    p50, p95, p99 = np.percentile(times, [50, 95, 99])
+    return {'p50_ms': p50 * 1000.0, 'p95_ms': p95 * 1000.0, 'p99_ms': p99 * 1000.0,
+            'mean_ms': float(np.mean(times)) * 1000.0, 'frames': len(times)}
+
+
+def evaluate(path, repeats=1, workers=None, cache_dir=None, threshold='hsv',
+             downscale=1, score_candidates=False):
+    """Run the detector over every sample and summarise the errors
+    and per-frame latencies."""
+    samples = loadSamples(path)
+    jobs = [(sample, repeats, cache_dir, threshold, downscale, score_candidates)
+            for sample in samples]
+    start = time.perf_counter()
+    if workers == 1:
+        results = [_evaluate(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_evaluate, jobs))
+    elapsed = time.perf_counter() - start
+    times = [t for result in results for t in result.get('times', [])]
+    labelled = [result for result in results if 'passed' in result]
+    summary = {'images': len(results),
+               'failed_to_read': sum(1 for result in results if 'error' in result),
+               'threshold': threshold,
+               'downscale': downscale,
+               'score_candidates': score_candidates,
+               'elapsed_s': elapsed,
+               'latency': percentiles(times)}
+    if labelled:
+        summary['passed'] = sum(1 for result in labelled if result['passed'])
+        summary['labelled'] = len(labelled)
+        summary['max_errors'] = [max(result['errors'][i] for result in labelled)
+                                 for i in range(4)]
+    return {'summary': summary, 'results': results}
+
+
+def benchmarkThresholds(path, repeats=100, cache_dir=None):
+    """Time the lookup table threshold against cvtColor and inRange on
+    every image, and measure how well the masks agree. Runs in this
+    process only, so the timings are comparable."""
+    lookup_table = ColourLookupTable()
+    times = {threshold: [] for threshold in THRESHOLDS}
+    agreement = []
+    for filename, _ in loadSamples(path):
+        image = loadImage(filename, cache_dir)
+        if image is None:
+            continue
+        hsv = np.empty(image.shape, np.uint8)
+        hsv_mask = np.empty(image.shape[:2], np.uint8)
+        lut_mask = np.empty(image.shape[:2], np.uint8)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            cv2.cvtColor(image, cv2.COLOR_BGR2HSV, hsv)
+            cv2.inRange(hsv, LOWER_COLOUR, UPPER_COLOUR, hsv_mask)
+            times['hsv'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            lookup_table.threshold(image, lut_mask)
+            times['lut'].append(time.perf_counter() - start)
+        agreement.append(float(np.mean(hsv_mask == lut_mask)))
+    return {'latency': {threshold: percentiles(times[threshold])
+                        for threshold in THRESHOLDS},
+            'mask_agreement': {'min': min(agreement) if agreement else None,
+                               'mean': float(np.mean(agreement)) if agreement else None}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run the vision detector over a set of images and report '
+                    'the errors and latency as JSON.')
+    parser.add_argument('path', help='directory of images, or a csv file of '
+                        'filename,x,y,w,h like tests/sample_img/tests.csv')
+    parser.add_argument('--repeats', help='times to run each image, for timing',
+                        type=int, default=10)
+    parser.add_argument('--workers', help='number of worker processes. Use 1 for '
+                        'latencies that are not affected by other workers',
+                        type=int, default=None)
+    parser.add_argument('--cache', help='directory to cache decoded images in',
+                        type=str, default=os.path.join('.cache', 'vision'))
+    parser.add_argument('--no-cache', help='decode the images every time',
+                        action='store_true')
+    parser.add_argument('--threshold', help='how to threshold the colours',
+                        choices=THRESHOLDS, default='hsv')
+    parser.add_argument('--downscale', help='find the target in a frame shrunk by '
+                        'this factor first, then refine at full resolution',
+                        type=int, default=1)
+    parser.add_argument('--score-candidates', help='pick the blob that looks most '
+                        'like the goal instead of the biggest', action='store_true')
+    parser.add_argument('--benchmark-thresholds', help='compare the speed and masks '
+                        'of the thresholding methods instead', action='store_true')
+    parser.add_argument('--output', help='file to write the JSON to (default stdout)',
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    cache_dir = None if args.no_cache else args.cache
+    if args.benchmark_thresholds:
+        report = benchmarkThresholds(args.path, args.repeats, cache_dir)
+    else:
+        report = evaluate(args.path, args.repeats, args.workers, cache_dir,
+                          args.threshold, args.downscale, args.score_candidates)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
@@ -0,0 +1,56 @@
+import argparse
+import glob
+import os
+
+import cv2
+import numpy as np
+
+from vision.vision import CameraCalibration
+
+
+def calibrate(filenames, pattern=(9, 6)):
+    """Work out the CameraCalibration from images of a chessboard with
+    pattern inside corners, taken at different angles and positions.
+    Returns the calibration and the RMS reprojection error in pixels."""
+    # The corners on the board, in units of one square
+    board = np.zeros((pattern[0] * pattern[1], 3), np.float32)
+    board[:, :2] = np.mgrid[0:pattern[0], 0:pattern[1]].T.reshape(-1, 2)
+    object_points = []
+    image_points = []
+    resolution = None
+    for filename in filenames:
+        image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            continue
+        found, corners = cv2.findChessboardCorners(image, pattern)
+        if not found:
+            continue
+        cv2.cornerSubPix(image, corners, (5, 5), (-1, -1),
+                         (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001))
+        object_points.append(board)
+        image_points.append(corners)
+        resolution = (image.shape[1], image.shape[0])
+    if len(image_points) < 3:
+        raise ValueError("Only found the chessboard in %d images, need at least 3"
+                         % len(image_points))
+    error, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(
+        object_points, image_points, resolution, None, None)
+    return CameraCalibration(camera_matrix, dist_coeffs, resolution), error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Calibrate the camera lens from images of a chessboard, '
+                    'for the vision filter to work out true bearings.')
+    parser.add_argument('path', help='directory of chessboard images')
+    parser.add_argument('--pattern', help='inside corners of the chessboard, '
+                        'as COLUMNSxROWS', type=str, default='9x6')
+    parser.add_argument('--output', help='file to write the calibration to',
+                        type=str, default='calibration.json')
+    args = parser.parse_args()
+
+    pattern = tuple(int(value) for value in args.pattern.split('x'))
+    calibration, error = calibrate(sorted(glob.glob(os.path.join(args.path, '*'))),
+                                   pattern)
+    calibration.save(args.output)
+    print("Reprojection error: %.3f pixels" % error)
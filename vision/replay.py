@@ -0,0 +1,186 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import cv2
+
+from vision.batch import IMAGE_EXTENSIONS, percentiles
+from vision.vision import (NTWrapper, ParallelPipeline, StageProfiler, TargetTracker,
+                           VisionPipeline)
+
+MODES = ('fast', 'realtime', 'recorded')
+STAGES = ('read', 'detect', 'show')
+
+
+def frameTimestamp(filename):
+    """The capture time from a file saved by FrameRecorder, or None."""
+    name = os.path.basename(filename)
+    try:
+        return float(name.split('_', 1)[0])
+    except ValueError:
+        return None
+
+
+def directorySource(path, fps=30.0):
+    """Yield (timestamp, read) for every image in a directory, where
+    read() decodes the image. Frames saved by FrameRecorder use their
+    capture times and skip the annotated copies, anything else is
+    assumed to be one frame every 1 / fps seconds in name order."""
+    filenames = [filename for filename in sorted(glob.glob(os.path.join(path, '*')))
+                 if filename.lower().endswith(IMAGE_EXTENSIONS) and
+                 not filename.endswith('_annotated.png')]
+    timestamps = [frameTimestamp(filename) for filename in filenames]
+    if None in timestamps:
+        timestamps = [index / fps for index in range(len(filenames))]
+    for timestamp, filename in sorted(zip(timestamps, filenames)):
+        yield timestamp, lambda filename=filename: cv2.imread(filename, cv2.IMREAD_COLOR)
+
+
+def videoSource(path, fps=None):
+    """Yield (timestamp, read) for every frame of a video file. The
+    frame is only decoded if read() is called."""
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError("Could not open video: %s" % path)
+    if fps is None:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    index = 0
+    try:
+        while cap.grab():
+            # Not every container knows the position, so fall back on
+            # counting frames
+            position = cap.get(cv2.CAP_PROP_POS_MSEC)
+            timestamp = position / 1000.0 if position > 0 or index == 0 else index / fps
+            yield timestamp, lambda: cap.retrieve()[1]
+            index += 1
+    finally:
+        cap.release()
+
+
+def openSource(path, fps=None):
+    if os.path.isdir(path):
+        return directorySource(path, fps or 30.0)
+    return videoSource(path, fps)
+
+
+def replay(source, mode='fast', process=None, show=False, profiler=None,
+           pipeline=None):
+    """Feed frames from source through process(image, capture_time) and
+    time each stage. In fast mode every frame is processed as soon as
+    the last one is done. Otherwise frames are fed at the rate they
+    were captured (recorded) or at a fixed rate (realtime, where source
+    is made with the rate wanted), and like the live camera any frame
+    that is stale by the time we are ready for it is dropped unread.
+    If process isn't given, the frames go through pipeline (by default a
+    VisionPipeline) with a TargetTracker, like on the robot. If profiler is
+    given, the pipeline's own stages are timed too."""
+    if mode not in MODES:
+        raise ValueError("mode must be one of %s" % (MODES,))
+    if process is None:
+        if pipeline is None:
+            pipeline = VisionPipeline(annotate=show, profiler=profiler)
+        tracker = TargetTracker(pipeline)
+
+        def process(image, capture_time):
+            return tracker.findTarget(image)[4]
+    times = {stage: [] for stage in STAGES}
+    frames = processed = dropped = 0
+    first = previous = None
+    start = time.monotonic()
+    start_wall = time.time()
+    for timestamp, read in source:
+        frames += 1
+        if first is None:
+            first = previous = timestamp
+        capture_time = time.time()
+        if mode != 'fast':
+            due = start + (timestamp - first)
+            now = time.monotonic()
+            if now < due:
+                time.sleep(due - now)
+            elif timestamp > previous and now > due + (timestamp - previous):
+                # Late by as long again as the last gap, so the next
+                # frame would already have arrived
+                dropped += 1
+                previous = timestamp
+                continue
+            capture_time = start_wall + (due - start)
+        previous = timestamp
+        stage_start = time.perf_counter()
+        image = read()
+        times['read'].append(time.perf_counter() - stage_start)
+        if image is None:
+            continue
+        stage_start = time.perf_counter()
+        image = process(image, capture_time)
+        times['detect'].append(time.perf_counter() - stage_start)
+        processed += 1
+        if show:
+            stage_start = time.perf_counter()
+            cv2.imshow('replay', image)
+            cv2.waitKey(1)
+            times['show'].append(time.perf_counter() - stage_start)
+    elapsed = time.monotonic() - start
+    report = {'mode': mode,
+              'frames': frames,
+              'processed': processed,
+              'dropped': dropped,
+              'elapsed_s': elapsed,
+              'fps': processed / elapsed if elapsed > 0 else 0.0,
+              'stages': {stage: percentiles(times[stage])
+                         for stage in STAGES if times[stage]}}
+    if profiler is not None:
+        report['pipeline'] = profiler.summary()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Replay recorded frames through the vision pipeline and '
+                    'report the throughput and time spent in each stage as JSON.')
+    parser.add_argument('path', help='directory of images (such as one saved by '
+                        'the frame recorder) or a video file')
+    parser.add_argument('--mode', help='fast runs flat out, realtime feeds frames '
+                        'at --fps and recorded at the times they were captured',
+                        choices=MODES, default='fast')
+    parser.add_argument('--fps', help='frame rate for realtime mode, and for '
+                        'images without timestamps', type=float, default=None)
+    parser.add_argument('--networktables', help='publish the results like the '
+                        'robot would, for a simulator to use', action='store_true')
+    parser.add_argument('--profile', help='also time each stage of the pipeline',
+                        action='store_true')
+    parser.add_argument('--parallel', help='try the colour ranges for different '
+                        'lighting at the same time on a thread pool', action='store_true')
+    parser.add_argument('--bands', help='with --parallel, split each frame into this '
+                        'many bands to threshold in parallel', type=int, default=1)
+    parser.add_argument('--show', help='display the annotated frames',
+                        action='store_true')
+    parser.add_argument('--output', help='file to write the JSON to (default stdout)',
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    # In realtime mode the frames are spaced evenly, whatever their timestamps
+    source = openSource(args.path, args.fps)
+    if args.mode == 'realtime':
+        fps = args.fps or 30.0
+        source = ((index / fps, read) for index, (_, read) in enumerate(source))
+    profiler = StageProfiler() if args.profile else None
+    pipeline = None
+    if args.parallel:
+        pipeline = ParallelPipeline(args.show, bands=args.bands, profiler=profiler)
+    process = None
+    if args.networktables:
+        process = NTWrapper(args.show, profiler=profiler,
+                            pipeline=pipeline).findTargetNetworkTables
+    report = replay(source, args.mode, process, args.show, profiler, pipeline)
+    if args.show:
+        cv2.destroyAllWindows()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
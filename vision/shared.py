@@ -0,0 +1,185 @@
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+# Frames and results are handed between processes through files in
+# /dev/shm, which are memory mapped by both sides. mmap rather than
+# multiprocessing.shared_memory so that this works on the roboRIO's Python.
+
+
+def _map(path, size=None):
+    # Create the file at size if given, otherwise open an existing one
+    if size is not None:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        os.ftruncate(fd, size)
+    else:
+        fd = os.open(path, os.O_RDWR)
+        size = os.fstat(fd).st_size
+    try:
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+class FrameRing:
+    """A ring of frame slots in shared memory, for one process to capture
+    into and another to process from, with no copying or serialisation.
+    The reader always gets the newest frame, like LatestFrameBuffer.
+
+    Each slot has the sequence number of the frame being written to it
+    (begin) and of the last one finished (end). A frame is only valid
+    while begin still matches, so the reader checks with valid() once it
+    is done that the writer hasn't lapped the ring and started on it."""
+
+    MAGIC = b'VFR1'
+    # magic, slots, height, width, channels, (padding), latest sequence
+    HEADER = struct.Struct('<4sIIIIIQ')
+    # begin sequence, end sequence, capture time
+    SLOT_HEADER = struct.Struct('<QQd')
+    # Keep the frames aligned for SIMD
+    ALIGNMENT = 64
+
+    def __init__(self, mm):
+        self._mm = mm
+        magic, self.slots, height, width, channels, _, _ = self.HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError("Not a frame ring")
+        self.shape = (height, width, channels)
+        self.frame_size = height * width * channels
+        self.slot_size = self._align(self.SLOT_HEADER.size) + self._align(self.frame_size)
+        # Zero copy views of each slot's frame
+        self.frames = [np.ndarray(self.shape, np.uint8, mm, self._frameOffset(slot))
+                       for slot in range(self.slots)]
+        self._writing = None
+
+    @classmethod
+    def _align(cls, size):
+        return (size + cls.ALIGNMENT - 1) // cls.ALIGNMENT * cls.ALIGNMENT
+
+    def _slotOffset(self, slot):
+        return self._align(self.HEADER.size) + slot * self.slot_size
+
+    def _frameOffset(self, slot):
+        return self._slotOffset(slot) + self._align(self.SLOT_HEADER.size)
+
+    @classmethod
+    def create(cls, path, shape, slots=4):
+        height, width = shape[:2]
+        channels = shape[2] if len(shape) > 2 else 1
+        slot_size = cls._align(cls.SLOT_HEADER.size) + cls._align(height * width * channels)
+        size = cls._align(cls.HEADER.size) + slots * slot_size
+        mm = _map(path, size)
+        # The file may be left over from last time, so clear out its slots
+        # and sequence numbers rather than carrying on from them
+        mm[:] = b'\0' * size
+        # Mark it as a ring last, so that nothing opens it half set up
+        cls.HEADER.pack_into(mm, 0, b'\0' * 4, slots, height, width, channels, 0, 0)
+        mm[:4] = cls.MAGIC
+        return cls(mm)
+
+    @classmethod
+    def open(cls, path):
+        return cls(_map(path))
+
+    def close(self):
+        self.frames = None
+        self._mm.close()
+
+    @property
+    def latest(self):
+        return struct.unpack_from('<Q', self._mm, self.HEADER.size - 8)[0]
+
+    def reserve(self):
+        """Return a view of the next slot for the writer to fill in
+        place, such as with VideoCapture.read(frame)."""
+        sequence = self.latest + 1
+        slot = sequence % self.slots
+        offset = self._slotOffset(slot)
+        struct.pack_into('<Q', self._mm, offset, sequence)
+        self._writing = sequence
+        return self.frames[slot]
+
+    def commit(self, timestamp):
+        """Publish the frame written into the reserved slot."""
+        sequence = self._writing
+        offset = self._slotOffset(sequence % self.slots)
+        struct.pack_into('<d', self._mm, offset + 16, timestamp)
+        struct.pack_into('<Q', self._mm, offset + 8, sequence)
+        struct.pack_into('<Q', self._mm, self.HEADER.size - 8, sequence)
+        self._writing = None
+        return sequence
+
+    def put(self, image, timestamp):
+        np.copyto(self.reserve(), image.reshape(self.shape))
+        return self.commit(timestamp)
+
+    def get(self, last_sequence=0, timeout=None, poll=0.001):
+        """Wait for a frame newer than last_sequence and return
+        (frame, timestamp, sequence), where frame is a view into the
+        ring, or None if we timed out."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            sequence = self.latest
+            if sequence > last_sequence:
+                slot = sequence % self.slots
+                begin, end, timestamp = self.SLOT_HEADER.unpack_from(
+                    self._mm, self._slotOffset(slot))
+                if begin == end == sequence:
+                    return self.frames[slot], timestamp, sequence
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+
+    def valid(self, sequence):
+        """Whether the frame from get() is still intact."""
+        offset = self._slotOffset(sequence % self.slots)
+        return struct.unpack_from('<Q', self._mm, offset)[0] == sequence
+
+
+class ResultSlot:
+    """The latest vision result in shared memory, for the robot code to
+    read without NetworkTables. The writer makes the counter odd while it
+    is writing and even again when it is done, so the reader can tell if
+    it read half of one result and half of another, and try again."""
+
+    # counter, then (sequence, time, x, y, w, h, bearing, elevation)
+    FORMAT = struct.Struct('<Q8d')
+
+    def __init__(self, mm):
+        self._mm = mm
+        self._counter = struct.unpack_from('<Q', mm, 0)[0]
+
+    @classmethod
+    def create(cls, path):
+        mm = _map(path, cls.FORMAT.size)
+        mm[:] = b'\0' * cls.FORMAT.size
+        return cls(mm)
+
+    @classmethod
+    def open(cls, path):
+        return cls(_map(path))
+
+    def close(self):
+        self._mm.close()
+
+    def write(self, result):
+        self._counter += 1
+        struct.pack_into('<Q', self._mm, 0, self._counter)
+        struct.pack_into('<8d', self._mm, 8, *result)
+        self._counter += 1
+        struct.pack_into('<Q', self._mm, 0, self._counter)
+
+    def read(self, retries=100):
+        """Return the latest result, or None if there isn't one yet or
+        it kept changing under us."""
+        for _ in range(retries):
+            counter = struct.unpack_from('<Q', self._mm, 0)[0]
+            if counter % 2:
+                continue
+            result = struct.unpack_from('<8d', self._mm, 8)
+            if struct.unpack_from('<Q', self._mm, 0)[0] == counter:
+                return result if counter else None
+        return None
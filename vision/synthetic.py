@@ -0,0 +1,151 @@
+import argparse
+import csv
+import math
+import os
+
+import cv2
+import numpy as np
+
+# The U of retro-reflective tape around the high goal, in inches
+GOAL_WIDTH = 20.0
+GOAL_HEIGHT = 14.0
+TAPE_WIDTH = 2.0
+# Colours (BGR) measured from the sample images, where the exposure is
+# turned right down so that only the tape lit by the LED ring shows up
+TAPE_COLOUR = (10, 55, 1)
+BACKGROUND_COLOUR = (1, 6, 1)
+
+
+def goalOutline():
+    """The outline of the U of tape, centred on its bounding box, with x
+    to the right and y down."""
+    w, h, t = GOAL_WIDTH / 2.0, GOAL_HEIGHT / 2.0, TAPE_WIDTH
+    return np.array([(-w, -h), (-w + t, -h), (-w + t, h - t), (w - t, h - t),
+                     (w - t, -h), (w, -h), (w, h), (-w, h)], np.float64)
+
+
+def cameraMatrix(width, height, horizontal_fov=math.radians(45.0)):
+    focal_length = width / 2.0 / math.tan(horizontal_fov / 2.0)
+    return np.array([[focal_length, 0.0, width / 2.0],
+                     [0.0, focal_length, height / 2.0],
+                     [0.0, 0.0, 1.0]])
+
+
+def projectGoal(resolution, distance, x, y, yaw=0.0, pitch=0.0, roll=0.0,
+                horizontal_fov=math.radians(45.0)):
+    """Return the outline of the goal in pixels, distance inches away
+    with its centre at the normalised position (x, y) in the image. yaw
+    turns it about the vertical, pitch about the horizontal (as when
+    looking up at it) and roll in the image plane, all in radians."""
+    width, height = resolution
+    camera_matrix = cameraMatrix(width, height, horizontal_fov)
+    # The ray through (x, y)
+    direction = np.array([x * width / 2.0 / camera_matrix[0, 0],
+                          y * height / 2.0 / camera_matrix[1, 1], 1.0])
+    translation = distance * direction / np.linalg.norm(direction)
+    rotation = (cv2.Rodrigues(np.array([0.0, 0.0, roll]))[0]
+                .dot(cv2.Rodrigues(np.array([pitch, 0.0, 0.0]))[0])
+                .dot(cv2.Rodrigues(np.array([0.0, yaw, 0.0]))[0]))
+    outline = goalOutline()
+    points = np.hstack((outline, np.zeros((len(outline), 1))))
+    projected, _ = cv2.projectPoints(points, cv2.Rodrigues(rotation)[0], translation,
+                                     camera_matrix, None)
+    return projected.reshape(-1, 2)
+
+
+def groundTruth(outline, resolution):
+    """The (x, y, w, h) that findTarget should report for the outline."""
+    width, height = resolution
+    (x, y), (w, h), rotation_angle = cv2.minAreaRect(outline.astype(np.float32))
+    if rotation_angle < -45.0 or rotation_angle > 45.0:
+        w, h = h, w
+    return (2.0 * x / width - 1.0, 2.0 * y / height - 1.0, w / width, h / height)
+
+
+def renderGoal(resolution, outline, lighting=1.0, noise=0.0, blur=0.0, rng=None):
+    """Draw the goal outline into a frame of the given resolution.
+    lighting scales the brightness of everything, noise is the standard
+    deviation of the noise added to each pixel and blur is the standard
+    deviation of the Gaussian blur, in pixels."""
+    width, height = resolution
+    if rng is None:
+        rng = np.random.RandomState()
+    image = np.empty((height, width, 3), np.float32)
+    image[:] = BACKGROUND_COLOUR
+    mask = np.zeros((height, width), np.uint8)
+    # Draw at 1/16th of a pixel for smooth edges
+    cv2.fillPoly(mask, [np.round(outline * 16).astype(np.int32)], 255,
+                 cv2.LINE_AA, 4)
+    coverage = (mask / 255.0)[:, :, np.newaxis]
+    image += coverage * (np.array(TAPE_COLOUR, np.float32) - image)
+    image *= lighting
+    if blur > 0.0:
+        image = cv2.GaussianBlur(image, (0, 0), blur)
+    if noise > 0.0:
+        image += rng.normal(0.0, noise, image.shape).astype(np.float32)
+    return np.clip(np.round(image), 0, 255).astype(np.uint8)
+
+
+def randomPose(resolution, rng, distance=(80.0, 200.0), yaw=(-0.5, 0.5),
+               pitch=(0.5, 0.9), roll=(-0.1, 0.1), margin=0.05):
+    """Pick a pose at random from the ranges, with the whole goal at least
+    margin (as a fraction of the frame) inside the edges. Returns the
+    outline and the pose."""
+    width, height = resolution
+    while True:
+        pose = {'distance': rng.uniform(*distance),
+                'x': rng.uniform(-0.8, 0.8),
+                'y': rng.uniform(-0.8, 0.8),
+                'yaw': rng.uniform(*yaw),
+                'pitch': rng.uniform(*pitch),
+                'roll': rng.uniform(*roll)}
+        outline = projectGoal(resolution, **pose)
+        if (outline[:, 0].min() >= margin * width and
+                outline[:, 0].max() <= (1.0 - margin) * width and
+                outline[:, 1].min() >= margin * height and
+                outline[:, 1].max() <= (1.0 - margin) * height):
+            return outline, pose
+
+
+def generate(directory, count, resolution=(320, 240), seed=0, lighting=(0.8, 1.2),
+             noise=1.0, blur=0.5, **ranges):
+    """Write count frames with a goal in a random pose to directory, along
+    with a tests.csv of the ground truth in the same format as
+    tests/sample_img/tests.csv. Returns the path to the csv."""
+    rng = np.random.RandomState(seed)
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, 'tests.csv')
+    with open(filename, 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', lineterminator='\n')
+        for i in range(count):
+            outline, _ = randomPose(resolution, rng, **ranges)
+            image = renderGoal(resolution, outline, rng.uniform(*lighting), noise,
+                               blur, rng)
+            name = 'synthetic%d.png' % i
+            cv2.imwrite(os.path.join(directory, name), image)
+            writer.writerow([name] + ['%.4f' % value
+                                      for value in groundTruth(outline, resolution)])
+    return filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Render frames of the goal in random poses with their ground '
+                    'truth, for benchmarking vision with python -m vision.batch.')
+    parser.add_argument('directory', help='where to write the frames and tests.csv')
+    parser.add_argument('--count', help='number of frames', type=int, default=100)
+    parser.add_argument('--resolution', help='WIDTHxHEIGHT', type=str, default='320x240')
+    parser.add_argument('--seed', help='random seed', type=int, default=0)
+    parser.add_argument('--lighting', help='range of brightness to scale by',
+                        type=float, nargs=2, default=(0.8, 1.2))
+    parser.add_argument('--noise', help='standard deviation of the pixel noise',
+                        type=float, default=1.0)
+    parser.add_argument('--blur', help='standard deviation of the blur, in pixels',
+                        type=float, default=0.5)
+    parser.add_argument('--distance', help='range of distances, in inches',
+                        type=float, nargs=2, default=(80.0, 200.0))
+    args = parser.parse_args()
+
+    resolution = tuple(int(value) for value in args.resolution.split('x'))
+    print(generate(args.directory, args.count, resolution, args.seed, args.lighting,
+                   args.noise, args.blur, distance=args.distance))
@@ -1,95 +1,1127 @@
 import cv2
 import numpy as np
 import argparse
+import bisect
+import hashlib
+import json
+import math
 import os
+import queue
 import re
+import threading
 import time
 import logging
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from networktables import NetworkTable
 
-def findTarget(image):
+# Define the colours to look for (in HSV)
+# Use values straight from GIMP
+LOWER_COLOUR = np.array([80 * 0.5, 70 * 255 / 100, 8 * 255 / 100])
+UPPER_COLOUR = np.array([220 * 0.5, 100 * 255 / 100, 63 * 255 / 100])
+# Colour ranges for ParallelPipeline to try at the same time, in case the
+# field is lit differently to where the samples were taken. Only the
+# saturation and value bounds are changed.
+LIGHTING_HYPOTHESES = (
+    (LOWER_COLOUR, UPPER_COLOUR),
+    # Washed out by bright lights
+    (np.array([80 * 0.5, 50 * 255 / 100, 30 * 255 / 100]),
+     np.array([220 * 0.5, 100 * 255 / 100, 100 * 255 / 100])),
+    # Dim
+    (np.array([80 * 0.5, 70 * 255 / 100, 3 * 255 / 100]),
+     np.array([220 * 0.5, 100 * 255 / 100, 40 * 255 / 100])),
+)
+# Kernel used to errode and dialate the mask
+KERNEL = np.ones((4, 4), np.uint8)
+# Shape of the goal's U of tape as seen from shooting range, measured
+# from the sample images. The fill ratio is the area of the tape over the
+# area of its bounding box.
+TARGET_ASPECT_RATIO = 2.5
+TARGET_FILL_RATIO = 0.3
+
+
+def findTarget(image, window=None, annotate=True):
+    x, y, w, h, image, _ = _findTarget(image, window, annotate=annotate)
+    return x, y, w, h, image
+
+
+def rankCandidates(stats, frame_area, aspect_ratio=TARGET_ASPECT_RATIO,
+                   fill_ratio=TARGET_FILL_RATIO, min_area=0.0005, max_area=0.05):
+    """Score each row of stats from connectedComponentsWithStats (without
+    the background row) on how much it looks like the goal. Returns the
+    indices of the plausible candidates, best first, and all the scores."""
+    widths = stats[:, cv2.CC_STAT_WIDTH].astype(np.float64)
+    heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+    areas = stats[:, cv2.CC_STAT_AREA].astype(np.float64)
+    # Bigger is better, but only if it is the right shape
+    aspect_error = np.log(widths / heights / aspect_ratio)
+    fill_error = areas / (widths * heights) - fill_ratio
+    scores = (areas * np.exp(-0.5 * (aspect_error / 0.4) ** 2) *
+              np.exp(-0.5 * (fill_error / 0.15) ** 2))
+    # Too small is noise, and too big is probably the lights
+    scores[(areas < min_area * frame_area) | (areas > max_area * frame_area)] = 0.0
+    ranked = np.argsort(-scores, kind='mergesort')
+    return ranked[scores[ranked] > 0.0], scores
+
+
+def _findTarget(image, window=None, buffers=None, annotate=True,
+                lookup_table=None, kernel=KERNEL, candidates=None, profiler=None):
+    # Returns the normalised target position and size along with the
+    # bounding rectangle of the target in pixels (or None if not found)
+    # If buffers is given, it is a tuple of full frame sized
+    # (hsv, mask, erosion, dilated, labels) images to write the results into
+    # If annotate is False nothing is drawn on the image
+    # If lookup_table is given it is used to threshold the image instead
+    # of converting it to HSV
+    # If candidates is a list, the blobs are scored on their shape rather
+    # than just taking the biggest, and the list is filled with
+    # (score, (x, y, w, h)) for every plausible blob, best first
+    # If profiler is given, the time taken by each stage is marked on it
     height = image.shape[0]
     width = image.shape[1]
-    # Convert from BGR colourspace to HSV. Makes thresholding easier.
-    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    # Define the colours to look for (in HSV)
-    # Use values straight from GIMP
-    lower_colour = np.array([80 * 0.5, 70 * 255 / 100, 8 * 255 / 100])
-    upper_colour = np.array([220 * 0.5, 100 * 255 / 100, 63 * 255 / 100])
-    # Create a mask that filters out only those colours
-    mask = cv2.inRange(hsv_image, lower_colour, upper_colour)
+    if buffers is None:
+        hsv_image = mask = erosion = dilated = labels = None
+    else:
+        hsv_image, mask, erosion, dilated, labels = buffers
+    # Only search inside the window (x0, y0, x1, y1) if we have one, but
+    # keep the contours in full frame coordinates
+    offset = (0, 0)
+    search_image = image
+    if window is not None:
+        x0, y0, x1, y1 = window
+        offset = (x0, y0)
+        search_image = image[y0:y1, x0:x1]
+        if buffers is not None:
+            hsv_image = hsv_image[y0:y1, x0:x1]
+            mask = mask[y0:y1, x0:x1]
+            erosion = erosion[y0:y1, x0:x1]
+            dilated = dilated[y0:y1, x0:x1]
+            labels = labels[y0:y1, x0:x1]
+    if lookup_table is None:
+        # Convert from BGR colourspace to HSV. Makes thresholding easier.
+        hsv_image = cv2.cvtColor(search_image, cv2.COLOR_BGR2HSV, hsv_image)
+        if profiler is not None:
+            profiler.mark('cvtColor')
+        # Create a mask that filters out only those colours
+        mask = cv2.inRange(hsv_image, LOWER_COLOUR, UPPER_COLOUR, mask)
+    else:
+        mask = lookup_table.threshold(search_image, mask)
+    if profiler is not None:
+        profiler.mark('threshold')
     # Errode and dialate the image to get rid of noise
-    kernel = np.ones((4, 4), np.uint8)
-    erosion = cv2.erode(mask, kernel, iterations=1)
-    dilated = cv2.dilate(erosion, kernel, iterations=1)
-    # Get the information for the contours
-    _, contours, __ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    # sort the contours into a list
-    areas = [cv2.contourArea(contour) for contour in contours]
-    # and retrieve the largest contour in the list
-    cnt = None
-    try:
-        cnt = contours[np.argmax(areas)]
-    except ValueError:
-        return 0.0, 0.0, 0.0, 0.0, image
+    erosion = cv2.erode(mask, kernel, erosion, iterations=1)
+    dilated = cv2.dilate(erosion, kernel, dilated, iterations=1)
+    if profiler is not None:
+        profiler.mark('morphology')
+    if candidates is not None:
+        cnt = _bestCandidate(dilated, labels, offset, width * height, candidates)
+        if profiler is not None:
+            profiler.mark('contours')
+        if cnt is None:
+            return 0.0, 0.0, 0.0, 0.0, image, None
+        if annotate:
+            cv2.drawContours(image, [cnt], 0, (255, 0, 0), 1)
+    else:
+        # Get the information for the contours
+        _, contours, __ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE,
+                                           offset=offset)
+        # sort the contours into a list
+        areas = [cv2.contourArea(contour) for contour in contours]
+        # and retrieve the largest contour in the list
+        cnt = None
+        try:
+            cnt = contours[np.argmax(areas)]
+        except ValueError:
+            return 0.0, 0.0, 0.0, 0.0, image, None
+        finally:
+            if profiler is not None:
+                profiler.mark('contours')
+
+        # Draw the contours
+        if annotate:
+            cv2.drawContours(image, contours, 0, (255, 0, 0), 1)
 
-    # Draw the contours
-    cv2.drawContours(image, contours, 0, (255, 0, 0), 1)
+        # get the area of the contour
+        area = cv2.contourArea(cnt)
+        if area / width / height > 0.05:
+            return 0.0, 0.0, 0.0, 0.0, image, None
+    result = _describeTarget(image, cnt, annotate)
+    if profiler is not None:
+        profiler.mark('minAreaRect')
+    return result
 
-    # get the area of the contour
-    area = cv2.contourArea(cnt)
-    if area / width / height > 0.05:
-        return 0.0, 0.0, 0.0, 0.0, image
+
+def _describeTarget(image, cnt, annotate=True):
+    # Returns the normalised position and size of the contour, along with
+    # its bounding rectangle in pixels
+    height = image.shape[0]
+    width = image.shape[1]
     # get a rectangle and then a box around the largest countour
     rect = cv2.minAreaRect(cnt)
 
     # Draw the box
-    box = cv2.boxPoints(rect)
-    box = np.int0(box)
-    cv2.drawContours(image, [box], 0, (0, 0, 255), 2)
+    if annotate:
+        box = cv2.boxPoints(rect)
+        box = np.int0(box)
+        cv2.drawContours(image, [box], 0, (0, 0, 255), 2)
     (xy, wh, rotation_angle) = (rect[0], rect[1], rect[2])
     # Converting the width and height variables to inbetween -1 and 1
     try:
         (x, y) = xy
         (w, h) = wh
     except ValueError:
-        return 0.0, 0.0, 0.0, 0.0, image
+        return 0.0, 0.0, 0.0, 0.0, image, None
     if rotation_angle < -45.0 or rotation_angle > 45.0:
         w, h = h, w
     # Draw the centre point
-    cv2.circle(image, (int(x), int(y)), 2, (0, 0, 255), 2)
+    if annotate:
+        cv2.circle(image, (int(x), int(y)), 2, (0, 0, 255), 2)
     x = ((2 * x) / width) - 1
     y = ((2 * y) / height) - 1
     w = w / width
     h = h / height
-    # Send the results to NetworkTables
-    # TODO!!
 
-    return x, y, w, h, image
+    return x, y, w, h, image, cv2.boundingRect(cnt)
+
+
+def _bestCandidate(dilated, labels, offset, frame_area, candidates):
+    # Label all the blobs in one pass and rank them on their statistics,
+    # then return the outline of the best one in full frame coordinates
+    del candidates[:]
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(dilated, labels,
+                                                           connectivity=8)
+    stats = stats[1:]  # Ignore the background
+    ranked, scores = rankCandidates(stats, frame_area)
+    if not len(ranked):
+        return None
+    for i in ranked:
+        x, y, w, h = stats[i, :4]
+        candidates.append((scores[i], (x + offset[0], y + offset[1], w, h)))
+    # Only need the outline of the winner
+    x, y, w, h = stats[ranked[0], :4]
+    blob = (labels[y:y + h, x:x + w] == ranked[0] + 1).astype(np.uint8)
+    _, contours, __ = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                       offset=(x + offset[0], y + offset[1]))
+    return max(contours, key=cv2.contourArea)
+
+
+class ColourLookupTable:
+    """Thresholds a BGR image by looking each pixel up in a table built
+    once from the HSV bounds, rather than converting every frame to HSV.
+    Colours are quantised to bits per channel to keep the table small,
+    so pixels right on the edge of the bounds can differ from inRange."""
+
+    def __init__(self, lower=LOWER_COLOUR, upper=UPPER_COLOUR, bits=5):
+        if not 1 <= bits <= 5:
+            raise ValueError("bits must be between 1 and 5 for a 16 bit index")
+        self.bits = bits
+        self.shift = 8 - bits
+        levels = 1 << bits
+        # Put the centre of every quantised colour through the HSV threshold,
+        # laid out so that the index is b << 2 * bits | g << bits | r
+        centres = ((np.arange(levels) << self.shift) +
+                   ((1 << self.shift) >> 1)).astype(np.uint8)
+        b, g, r = np.meshgrid(centres, centres, centres, indexing='ij')
+        colours = np.dstack((b.reshape(levels, -1), g.reshape(levels, -1),
+                             r.reshape(levels, -1)))
+        hsv = cv2.cvtColor(colours, cv2.COLOR_BGR2HSV)
+        self.table = cv2.inRange(hsv, lower, upper).reshape(-1)
+        self._scratch = None
+
+    def threshold(self, image, mask=None):
+        height, width = image.shape[:2]
+        if mask is None:
+            mask = np.empty((height, width), np.uint8)
+        # Only reallocate the scratch space if we get a bigger image
+        if (self._scratch is None or self._scratch[0].shape[0] < height or
+                self._scratch[0].shape[1] < width):
+            self._scratch = (np.empty((height, width, 3), np.uint8),
+                             np.empty((height, width), np.uint16),
+                             np.empty((height, width), np.uint16))
+        quantised, index, shifted = (scratch[:height, :width]
+                                     for scratch in self._scratch)
+        np.right_shift(image, self.shift, out=quantised)
+        np.left_shift(quantised[..., 0], 2 * self.bits, out=index, dtype=np.uint16)
+        np.left_shift(quantised[..., 1], self.bits, out=shifted, dtype=np.uint16)
+        np.bitwise_or(index, shifted, out=index)
+        np.bitwise_or(index, quantised[..., 2], out=index, dtype=np.uint16)
+        np.take(self.table, index, out=mask, mode='clip')
+        return mask
+
+
+class StageProfiler:
+    """Rolling histograms of how long each stage of finding the target
+    takes, over the last window frames. start() begins a frame, mark()
+    ends the current stage and stop() ends the frame, which is recorded
+    as the total. The bins are spaced logarithmically, so percentiles
+    are only accurate to about 12%."""
+
+    # 20 bins per decade from 1us to 10s
+    BIN_EDGES = [10 ** (exponent / 20.0) for exponent in range(-120, 21)]
+
+    def __init__(self, window=300, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._counts = {}
+        self._samples = {}
+        self._last = None
+        self._start = None
+
+    def start(self):
+        self._start = self._last = self.clock()
+
+    def mark(self, stage):
+        now = self.clock()
+        self.add(stage, now - self._last)
+        self._last = now
+
+    def stop(self):
+        self.add('total', self.clock() - self._start)
+
+    def add(self, stage, duration):
+        try:
+            counts = self._counts[stage]
+            samples = self._samples[stage]
+        except KeyError:
+            counts = self._counts[stage] = [0] * (len(self.BIN_EDGES) + 1)
+            samples = self._samples[stage] = deque(maxlen=self.window)
+        if len(samples) == self.window:
+            # Forget the oldest sample as it falls out of the window
+            counts[samples[0]] -= 1
+        index = bisect.bisect_left(self.BIN_EDGES, duration)
+        counts[index] += 1
+        samples.append(index)
+
+    def stages(self):
+        return list(self._counts)
+
+    def percentile(self, stage, q):
+        """The upper edge of the bin holding the q'th percentile, in
+        seconds, or None if the stage hasn't been timed."""
+        samples = self._samples.get(stage)
+        if not samples:
+            return None
+        target = q / 100.0 * len(samples)
+        total = 0
+        for index, count in enumerate(self._counts[stage]):
+            total += count
+            if total >= target and total > 0:
+                break
+        return self.BIN_EDGES[min(index, len(self.BIN_EDGES) - 1)]
+
+    def summary(self, percentiles=(50, 95, 99)):
+        return {stage: dict(('p%d_ms' % q, self.percentile(stage, q) * 1000.0)
+                            for q in percentiles)
+                for stage in self.stages()}
+
+
+class VisionPipeline:
+    """Does the same as findTarget, but keeps the intermediate images
+    between frames so that OpenCV can write straight into them instead
+    of allocating new ones every frame.
+
+    If downscale is more than 1, the target is first found in a copy of
+    the frame shrunk by that factor, and then only the matching region of
+    the full resolution frame is searched to get the exact size and
+    position. This keeps the cost of a higher resolution camera down.
+
+    If profiler is a StageProfiler, every search is timed on it."""
+
+    def __init__(self, annotate=True, lookup_table=None, downscale=1,
+                 coarse_padding=0.25, score_candidates=False, profiler=None):
+        self.annotate = annotate
+        self.profiler = profiler
+        self.lookup_table = lookup_table
+        # Pick the blob that looks most like the goal rather than the
+        # biggest one, keeping the ranked list in candidates
+        self.score_candidates = score_candidates
+        self.candidates = []
+        self.coarse_padding = coarse_padding  # Fraction of the target size
+        self._buffers = {}
+        self.setDownscale(downscale)
+
+    def setDownscale(self, downscale):
+        self.downscale = downscale
+        # Shrink the noise filter along with the image so that it doesn't
+        # wipe out the target in the small frame
+        size = max(KERNEL.shape[0] // downscale, 1)
+        self.coarse_kernel = np.ones((size, size), np.uint8)
+        self._small_images = {}
+
+    def buffers(self, shape):
+        # Buffers are keyed on the frame shape, so a change in resolution
+        # just gets a new set
+        try:
+            return self._buffers[shape]
+        except KeyError:
+            height, width = shape[:2]
+            buffers = (np.empty((height, width, 3), np.uint8),  # hsv
+                       np.empty((height, width), np.uint8),  # mask
+                       np.empty((height, width), np.uint8),  # erosion
+                       np.empty((height, width), np.uint8),  # dilated
+                       np.empty((height, width), np.int32))  # labels
+            self._buffers[shape] = buffers
+            return buffers
+
+    def findTarget(self, image, window=None):
+        x, y, w, h, image, _ = self._findTarget(image, window)
+        return x, y, w, h, image
+
+    def _findTarget(self, image, window=None):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
+        result = None
+        if window is None and self.downscale > 1:
+            window = self.coarseWindow(image)
+            if profiler is not None:
+                profiler.mark('coarse')
+            if window is None:
+                result = 0.0, 0.0, 0.0, 0.0, image, None
+        if result is None:
+            result = self._search(image, window)
+        if profiler is not None:
+            profiler.stop()
+        return result
+
+    def _search(self, image, window):
+        return _findTarget(image, window, self.buffers(image.shape),
+                           self.annotate, self.lookup_table,
+                           candidates=self.candidates if self.score_candidates else None,
+                           profiler=self.profiler)
+
+    def coarseWindow(self, image):
+        # Find the target in the shrunk frame, and return the region
+        # (x0, y0, x1, y1) of the full frame it is in, or None
+        height, width = image.shape[:2]
+        try:
+            small = self._small_images[image.shape]
+        except KeyError:
+            small = np.empty((height // self.downscale, width // self.downscale,
+                              image.shape[2]), np.uint8)
+            self._small_images[image.shape] = small
+        cv2.resize(image, (small.shape[1], small.shape[0]), small,
+                   interpolation=cv2.INTER_AREA)
+        bounds = _findTarget(small, None, self.buffers(small.shape), False,
+                             self.lookup_table, self.coarse_kernel,
+                             [] if self.score_candidates else None)[-1]
+        if bounds is None:
+            return None
+        # Scale back up, with some padding for anything lost in the shrinking
+        x, y, w, h = (value * self.downscale for value in bounds)
+        pad_x = int(w * self.coarse_padding) + self.downscale
+        pad_y = int(h * self.coarse_padding) + self.downscale
+        return (max(x - pad_x, 0), max(y - pad_y, 0),
+                min(x + w + pad_x, width), min(y + h + pad_y, height))
+
+
+class ParallelPipeline(VisionPipeline):
+    """Searches with several colour ranges at once on a pool of threads,
+    and keeps whichever range finds the blob that looks most like the
+    goal. OpenCV releases the GIL, so the threads can use the other
+    cores. Each frame can also be split into horizontal bands, which are
+    converted, thresholded and filtered in parallel. The coarse search
+    when downscaling only uses the first range."""
+
+    def __init__(self, annotate=True, hypotheses=LIGHTING_HYPOTHESES, bands=1,
+                 workers=None, downscale=1, coarse_padding=0.25, profiler=None):
+        super().__init__(annotate, downscale=downscale, coarse_padding=coarse_padding,
+                         score_candidates=True, profiler=profiler)
+        self.hypotheses = hypotheses
+        self.bands = bands
+        self.hypothesis = None  # Index of the range that found the target
+        if workers is None:
+            workers = min(len(hypotheses) * bands, os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(workers)
+        self._hypothesis_buffers = {}
+        self._scratch = {}
+
+    def close(self):
+        self._executor.shutdown()
+
+    def hypothesisBuffers(self, shape):
+        # A (dilated, labels) pair of full frame images for each range
+        try:
+            return self._hypothesis_buffers[shape]
+        except KeyError:
+            height, width = shape[:2]
+            buffers = [(np.empty((height, width), np.uint8),
+                        np.empty((height, width), np.int32))
+                       for _ in self.hypotheses]
+            self._hypothesis_buffers[shape] = buffers
+            return buffers
+
+    def scratch(self, key, height, width):
+        # (mask, erosion, dilated) for one band of one range. Only
+        # reallocated if we get a bigger band.
+        scratch = self._scratch.get(key)
+        if scratch is None or scratch[0].shape[0] < height or scratch[0].shape[1] < width:
+            scratch = tuple(np.empty((height, width), np.uint8) for _ in range(3))
+            self._scratch[key] = scratch
+        return tuple(image[:height, :width] for image in scratch)
+
+    def bandRanges(self, height):
+        # (y0, y1, top, bottom) for each band, where top and bottom take in
+        # enough rows either side for the erode and dilate to give the
+        # same answer as filtering the whole frame
+        halo = 2 * KERNEL.shape[0]
+        edges = [height * i // self.bands for i in range(self.bands + 1)]
+        return [(y0, y1, max(y0 - halo, 0), min(y1 + halo, height))
+                for y0, y1 in zip(edges, edges[1:])]
+
+    def _filterBand(self, hsv, hypothesis, dilated, scratch, y0, y1, top, bottom):
+        lower, upper = self.hypotheses[hypothesis]
+        mask, erosion, filtered = scratch
+        cv2.inRange(hsv[top:bottom], lower, upper, mask)
+        cv2.erode(mask, KERNEL, erosion, iterations=1)
+        cv2.dilate(erosion, KERNEL, filtered, iterations=1)
+        dilated[y0:y1] = filtered[y0 - top:y1 - top]
+
+    def _search(self, image, window):
+        height, width = image.shape[:2]
+        hsv = self.buffers(image.shape)[0]
+        hypothesis_buffers = self.hypothesisBuffers(image.shape)
+        offset = (0, 0)
+        search_image = image
+        if window is not None:
+            x0, y0, x1, y1 = window
+            offset = (x0, y0)
+            search_image = image[y0:y1, x0:x1]
+            hsv = hsv[y0:y1, x0:x1]
+            hypothesis_buffers = [(dilated[y0:y1, x0:x1], labels[y0:y1, x0:x1])
+                                  for dilated, labels in hypothesis_buffers]
+        bands = self.bandRanges(search_image.shape[0])
+        executor = self._executor
+        # Convert to HSV once, then try every range on every band
+        for future in [executor.submit(cv2.cvtColor, search_image[y0:y1],
+                                       cv2.COLOR_BGR2HSV, hsv[y0:y1])
+                       for y0, y1, _, _ in bands]:
+            future.result()
+        futures = []
+        for hypothesis, (dilated, _) in enumerate(hypothesis_buffers):
+            for band, (y0, y1, top, bottom) in enumerate(bands):
+                scratch = self.scratch((hypothesis, band), bottom - top,
+                                       search_image.shape[1])
+                futures.append(executor.submit(self._filterBand, hsv, hypothesis,
+                                               dilated, scratch, y0, y1, top, bottom))
+        for future in futures:
+            future.result()
+        if self.profiler is not None:
+            self.profiler.mark('threshold')
+        candidates = [[] for _ in self.hypotheses]
+        contours = [future.result() for future in
+                    [executor.submit(_bestCandidate, dilated, labels, offset,
+                                     width * height, candidates[hypothesis])
+                     for hypothesis, (dilated, labels) in enumerate(hypothesis_buffers)]]
+        if self.profiler is not None:
+            self.profiler.mark('contours')
+        # Keep whichever range found the best looking blob
+        best = None
+        for hypothesis, cnt in enumerate(contours):
+            if cnt is not None and (best is None or
+                                    candidates[hypothesis][0][0] > candidates[best][0][0]):
+                best = hypothesis
+        self.hypothesis = best
+        if best is None:
+            self.candidates = []
+            return 0.0, 0.0, 0.0, 0.0, image, None
+        self.candidates = candidates[best]
+        if self.annotate:
+            cv2.drawContours(image, [contours[best]], 0, (255, 0, 0), 1)
+        result = _describeTarget(image, contours[best], self.annotate)
+        if self.profiler is not None:
+            self.profiler.mark('minAreaRect')
+        return result
+
+
+class FrameGovernor:
+    """Keeps the time spent processing each frame under budget seconds,
+    so that frames don't queue up behind a slow one. When the average
+    processing time goes over budget, step to the next level of LEVELS,
+    which are (downscale, process 1 in this many frames). Step back once
+    it falls under recover_fraction of the budget. After a change the
+    level is held for hold_frames to see what difference it made."""
+
+    LEVELS = ((1, 1), (2, 1), (4, 1), (4, 2), (4, 3))
+
+    def __init__(self, budget, levels=LEVELS, max_downscale=4, alpha=0.2,
+                 recover_fraction=0.5, hold_frames=30):
+        self.budget = budget
+        # Small frames aren't shrunk past max_downscale, but they can still
+        # skip frames
+        self.levels = []
+        for downscale, interval in levels:
+            level = (min(downscale, max_downscale), interval)
+            if level not in self.levels:
+                self.levels.append(level)
+        self.alpha = alpha
+        self.recover_fraction = recover_fraction
+        self.hold_frames = hold_frames
+        self.level = 0
+        self.average = None
+        self.skipped = 0
+        self._frames = 0
+        self._hold = hold_frames
+
+    @property
+    def downscale(self):
+        return self.levels[self.level][0]
+
+    @property
+    def frame_interval(self):
+        return self.levels[self.level][1]
+
+    def mode(self):
+        return "%dx downscale, 1 in %d frames" % self.levels[self.level]
+
+    def skip(self):
+        """Call once per frame. Returns True if it shouldn't be processed."""
+        self._frames += 1
+        if self._frames % self.frame_interval:
+            self.skipped += 1
+            return True
+        return False
+
+    def update(self, duration):
+        """Add how long a processed frame took. Returns True if the level
+        changed."""
+        if self.average is None:
+            self.average = duration
+        else:
+            self.average += self.alpha * (duration - self.average)
+        if self._hold > 0:
+            self._hold -= 1
+            return False
+        if self.average > self.budget and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif (self.average < self.recover_fraction * self.budget and
+              self.level > 0):
+            self.level -= 1
+        else:
+            return False
+        # Start again with what it takes at the new level
+        self.average = None
+        self._hold = self.hold_frames
+        self._frames = 0
+        return True
+
+
+class TargetTracker:
+    """Search only a padded window around the last target found.
+    Falls back to searching the whole frame when the target is lost,
+    and every max_tracked_frames frames in case something better has
+    come into view."""
+
+    def __init__(self, pipeline=None, padding=1.0, min_padding=8,
+                 max_tracked_frames=30):
+        if pipeline is None:
+            pipeline = VisionPipeline()
+        self.pipeline = pipeline
+        self.padding = padding  # Fraction of the target size
+        self.min_padding = min_padding  # pixels
+        self.max_tracked_frames = max_tracked_frames
+        self.reset()
+
+    def reset(self):
+        self.bounds = None
+        self.tracked_frames = 0
+
+    def window(self, width, height):
+        if self.bounds is None or self.tracked_frames >= self.max_tracked_frames:
+            return None
+        x, y, w, h = self.bounds
+        pad_x = max(int(w * self.padding), self.min_padding)
+        pad_y = max(int(h * self.padding), self.min_padding)
+        return (max(x - pad_x, 0), max(y - pad_y, 0),
+                min(x + w + pad_x, width), min(y + h + pad_y, height))
+
+    def findTarget(self, image):
+        window = self.window(image.shape[1], image.shape[0])
+        if window is not None:
+            x, y, w, h, image, bounds = self.pipeline._findTarget(image, window)
+            if bounds is not None:
+                self.bounds = bounds
+                self.tracked_frames += 1
+                return x, y, w, h, image
+        # Lost the target (or time for a fresh look), so search everywhere
+        x, y, w, h, image, self.bounds = self.pipeline._findTarget(image)
+        self.tracked_frames = 0
+        return x, y, w, h, image
+
+
+class CameraCalibration:
+    """The camera matrix and distortion coefficients from
+    cv2.calibrateCamera, for images of the given resolution.
+
+    Everything that depends on the resolution - the undistortion maps and
+    the bearing and elevation of every pixel - is worked out the first
+    time it is needed and cached in cache_dir, so it only has to be done
+    once per resolution rather than every frame. Bearings are anticlockwise
+    (left) positive like the gyro, and elevations are up positive."""
+
+    def __init__(self, camera_matrix, dist_coeffs, resolution, cache_dir=None):
+        self.camera_matrix = np.array(camera_matrix, np.float64).reshape(3, 3)
+        self.dist_coeffs = np.array(dist_coeffs, np.float64).reshape(-1)
+        self.resolution = tuple(resolution)
+        self.cache_dir = cache_dir
+        self._tables = {}
+
+    @classmethod
+    def load(cls, filename, cache_dir=None):
+        with open(filename) as f:
+            calibration = json.load(f)
+        return cls(calibration['camera_matrix'], calibration['dist_coeffs'],
+                   calibration['resolution'], cache_dir)
+
+    @classmethod
+    def pinhole(cls, horizontal_fov, resolution=(160, 120), cache_dir=None):
+        # A perfect lens, for when the camera hasn't been calibrated
+        width, height = resolution
+        focal_length = width / 2.0 / math.tan(horizontal_fov / 2.0)
+        return cls([[focal_length, 0.0, width / 2.0],
+                    [0.0, focal_length, height / 2.0],
+                    [0.0, 0.0, 1.0]], [0.0] * 5, resolution, cache_dir)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'camera_matrix': self.camera_matrix.tolist(),
+                       'dist_coeffs': self.dist_coeffs.tolist(),
+                       'resolution': list(self.resolution)}, f, indent=2)
+
+    def cameraMatrix(self, width, height):
+        # The same lens at another resolution just scales the matrix
+        scale = np.array([[width / self.resolution[0]], [height / self.resolution[1]], [1.0]])
+        return self.camera_matrix * scale
+
+    def tables(self, width, height):
+        """Return (map1, map2, bearing, elevation) for images of this size,
+        where map1 and map2 are for cv2.remap and bearing and elevation
+        are the angles to the centre of each pixel."""
+        try:
+            return self._tables[(width, height)]
+        except KeyError:
+            pass
+        cached = None
+        if self.cache_dir is not None:
+            # Key the cache on the calibration too, so that recalibrating
+            # invalidates it
+            key = hashlib.sha1(self.camera_matrix.tobytes() + self.dist_coeffs.tobytes() +
+                               np.array(self.resolution, np.float64).tobytes()).hexdigest()
+            cached = os.path.join(self.cache_dir, 'calibration_%s_%dx%d.npz'
+                                  % (key[:16], width, height))
+        tables = None
+        if cached is not None and os.path.exists(cached):
+            try:
+                with np.load(cached) as data:
+                    tables = (data['map1'], data['map2'], data['bearing'], data['elevation'])
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                # Work them out again and overwrite the bad file
+                logging.getLogger("vision").exception("Could not read %s" % cached)
+        if tables is None:
+            tables = self._computeTables(width, height)
+            if cached is not None:
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    # Write then rename so that nothing reads a partial file
+                    partial = cached + '.%d.tmp' % os.getpid()
+                    with open(partial, 'wb') as f:
+                        np.savez(f, map1=tables[0], map2=tables[1], bearing=tables[2],
+                                 elevation=tables[3])
+                    os.replace(partial, cached)
+                except OSError:
+                    # The cache only saves time - keep the tables in memory
+                    logging.getLogger("vision").exception("Could not cache %s" % cached)
+        self._tables[(width, height)] = tables
+        return tables
+
+    def _computeTables(self, width, height):
+        camera_matrix = self.cameraMatrix(width, height)
+        map1, map2 = cv2.initUndistortRectifyMap(camera_matrix, self.dist_coeffs, None,
+                                                 camera_matrix, (width, height),
+                                                 cv2.CV_16SC2)
+        # Where the ray through each pixel would hit a plane one unit in
+        # front of a perfect lens
+        u, v = np.meshgrid(np.arange(width, dtype=np.float64),
+                           np.arange(height, dtype=np.float64))
+        points = np.dstack((u, v)).reshape(-1, 1, 2)
+        undistorted = cv2.undistortPoints(points, camera_matrix, self.dist_coeffs)
+        x = undistorted[:, 0, 0].reshape(height, width)
+        y = undistorted[:, 0, 1].reshape(height, width)
+        bearing = -np.arctan(x)
+        elevation = -np.arctan2(y, np.sqrt(1.0 + x * x))
+        return map1, map2, bearing.astype(np.float32), elevation.astype(np.float32)
+
+    def undistort(self, image, out=None):
+        map1, map2 = self.tables(image.shape[1], image.shape[0])[:2]
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, out)
+
+    def angles(self, x, y, width, height):
+        """The (bearing, elevation) in radians of the normalised position
+        (x, y) from findTarget, in an image of width by height."""
+        bearing, elevation = self.tables(width, height)[2:]
+        # Interpolate between the four pixels around the point, or carry
+        # on from the last two for the half pixel past the edge
+        u = (x + 1.0) * width / 2.0
+        v = (y + 1.0) * height / 2.0
+        u0 = min(max(int(math.floor(u)), 0), width - 2)
+        v0 = min(max(int(math.floor(v)), 0), height - 2)
+        du = u - u0
+        dv = v - v0
+        results = []
+        for table in (bearing, elevation):
+            top = table[v0, u0] * (1.0 - du) + table[v0, u0 + 1] * du
+            bottom = table[v0 + 1, u0] * (1.0 - du) + table[v0 + 1, u0 + 1] * du
+            results.append(float(top * (1.0 - dv) + bottom * dv))
+        return tuple(results)
+
 
 class NTWrapper:  # pragma: no cover
-    def __init__(self):
+    def __init__(self, annotate=True, publish_keys=False, recorder=None,
+                 record_all=False, profiler=None, perf_period=1.0, governor=None,
+                 calibration=None, pipeline=None):
         NetworkTable.setIPAddress('127.0.0.1')
         NetworkTable.setClientMode()
         NetworkTable.initialize()
         self.nt = NetworkTable.getTable("vision")
+        if pipeline is None:
+            pipeline = VisionPipeline(annotate, profiler=profiler)
+        self.tracker = TargetTracker(pipeline)
+        # Stage timings go to vision/perf every perf_period seconds
+        self.profiler = profiler
+        self.perf_nt = self.nt.getSubTable('perf')
+        self.perf_period = perf_period
+        self.next_perf_time = time.monotonic() + perf_period
+        # Cut the work per frame if we can't keep up
+        self.governor = governor
+        # Used to work out the true bearing and elevation of the target
+        self.calibration = calibration
+        # Also publish x, y, w, h and time as separate keys, for dashboards
+        self.publish_keys = publish_keys
+        self.sequence = 0
+        # Frames are saved when the robot changes record_request, or all
+        # of them if record_all is set
+        self.recorder = recorder
+        self.record_all = record_all
+        self.record_request = self.nt.getNumber('record_request', 0.0)
+        # The governor's level goes to vision/governor, as the robot
+        # expects every key in vision itself to be a number
+        self.governor_nt = self.nt.getSubTable('governor')
+        if governor is not None:
+            self.publishMode()
+
+    def publishMode(self):
+        governor = self.governor
+        self.tracker.pipeline.setDownscale(governor.downscale)
+        self.governor_nt.putString('mode', governor.mode())
+        self.governor_nt.putNumber('level', governor.level)
+
+    def recordRequested(self):
+        request = self.nt.getNumber('record_request', 0.0)
+        if request != self.record_request:
+            self.record_request = request
+            return True
+        return False
+
+    def publishPerf(self):
+        for stage, percentiles in self.profiler.summary().items():
+            for name, value in percentiles.items():
+                self.perf_nt.putNumber('%s_%s' % (stage, name), value)
 
-    def findTargetNetworkTables(self, image):
-        x, y, w, h, img = findTarget(image)
-        # TODO - send to network tables
-        self.nt.putDouble('x', x)
-        self.nt.putDouble('y', y)
-        self.nt.putDouble('w', w)
-        self.nt.putDouble('h', h)
-        self.nt.putDouble('time', time.time())
+    def findTargetNetworkTables(self, image, capture_time=None):
+        # If we know when the frame was captured, publish that as the time
+        # of the result. Otherwise the best we can do is now.
+        if capture_time is None:
+            capture_time = time.time()
+        if self.governor is not None and self.governor.skip():
+            return image
+        start = time.monotonic()
+        raw = None
+        if self.recorder is not None and (self.recordRequested() or self.record_all):
+            # Keep a copy from before we draw on it
+            raw = image.copy()
+        x, y, w, h, img = self.tracker.findTarget(image)
+        if self.governor is not None:
+            if self.governor.update(time.monotonic() - start):
+                self.publishMode()
+        self.sequence += 1
+        # NaN tells the robot to work the bearing out from x itself
+        bearing = elevation = float('nan')
+        if self.calibration is not None and w > 0.0:
+            bearing, elevation = self.calibration.angles(x, y, image.shape[1],
+                                                         image.shape[0])
+        # Send the whole result as one entry, so it arrives in one update
+        # and can't be read half old and half new
+        self.nt.putNumberArray('result', (self.sequence, capture_time, x, y, w, h,
+                                          bearing, elevation))
+        if self.publish_keys:
+            self.nt.putDouble('x', x)
+            self.nt.putDouble('y', y)
+            self.nt.putDouble('w', w)
+            self.nt.putDouble('h', h)
+            self.nt.putDouble('time', capture_time)
+        if raw is not None:
+            # The filter's image gets reused once we return it, so the
+            # recorder needs its own copy of the annotated one too
+            annotated = img.copy() if self.tracker.pipeline.annotate else None
+            self.recorder.record(capture_time, raw, annotated)
+        if self.profiler is not None:
+            now = time.monotonic()
+            if now >= self.next_perf_time:
+                self.publishPerf()
+                self.next_perf_time = now + self.perf_period
         return img
 
 
+class LatestFrameBuffer:
+    """A one slot buffer for handing frames between threads. Putting a
+    frame replaces any frame that hasn't been read yet, so the reader
+    always gets the newest frame and never falls behind."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._timestamp = None
+        self.sequence = 0  # Number of frames put in the buffer
+        self.dropped = 0  # Number of frames replaced before being read
+        self.closed = False
+
+    def put(self, frame, timestamp):
+        with self._condition:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self._timestamp = timestamp
+            self.sequence += 1
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Wait for a new frame and return (frame, timestamp, sequence),
+        or None if the buffer is closed or we timed out."""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._frame is not None or self.closed, timeout)
+            if self._frame is None:
+                return None
+            frame = self._frame
+            self._frame = None
+            return frame, self._timestamp, self.sequence
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class FrameRecorder:
+    """Saves frames to disk on a background thread. record() never
+    blocks - if the writer can't keep up the frame is dropped instead.
+    The oldest files are deleted to keep the directory under max_bytes.
+    The directory is only created when the first frame is written, so a
+    missing or read-only one doesn't stop the filter starting."""
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024, queue_size=4):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        # (path, size) of the files in the directory, oldest first, or
+        # None until the directory has been opened
+        self._files = None
+        self._bytes = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, timestamp, raw, annotated=None):
+        # The images must not be changed after they are handed over
+        try:
+            self._queue.put_nowait((timestamp, raw, annotated))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        # Finish writing what we have, then stop the thread
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            timestamp, raw, annotated = item
+            try:
+                self._write("%.6f_raw.png" % timestamp, raw)
+                if annotated is not None:
+                    self._write("%.6f_annotated.png" % timestamp, annotated)
+                self.written += 1
+            except (cv2.error, OSError):
+                # Don't let a full disk stop us recording the next one
+                logging.getLogger("vision").exception("Could not save frame")
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # The names start with the capture time, so sorting them puts
+        # them in order. Count anything from last time against the budget.
+        files = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.png'):
+                path = os.path.join(self.directory, name)
+                files.append((path, os.path.getsize(path)))
+        self._files = files
+        self._bytes = sum(size for path, size in files)
+
+    def _write(self, name, image):
+        if self._files is None:
+            # If this fails it is logged, and tried again next frame
+            self._open()
+        path = os.path.join(self.directory, name)
+        retval, data = cv2.imencode('.png', image)
+        if not retval:
+            return
+        with open(path, 'wb') as f:
+            f.write(data.tobytes())
+        self._files.append((path, len(data)))
+        self._bytes += len(data)
+        # Make room by throwing away the oldest frames
+        while self._bytes > self.max_bytes and len(self._files) > 1:
+            oldest, size = self._files.pop(0)
+            self._bytes -= size
+            try:
+                os.remove(oldest)
+            except OSError:
+                pass
+
+
+def captureFrames(cap, frames, stop):
+    # Read frames as fast as the camera gives them to us, so that they
+    # don't queue up in the driver while we are processing
+    while not stop.is_set():
+        retval, image = cap.read()
+        if not retval:
+            break
+        frames.put(image, time.time())
+    frames.close()
+
+
+def processFrames(frames, process, results=None):
+    # process is called with (image, capture_time) and returns the
+    # annotated image, which is passed on to results if we have it
+    logger = logging.getLogger("vision")
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        image, capture_time, sequence = item
+        image = process(image, capture_time)
+        latency = time.time() - capture_time
+        logger.info("Frame %d latency: %.1f ms (%d dropped)"
+                    % (sequence, latency * 1000.0, frames.dropped))
+        if results is not None:
+            results.put(image, capture_time)
+    if results is not None:
+        results.close()
+
+
 def init_filter():  # pragma: no cover
-    ntw = NTWrapper()
+    # Drawing on the frames is wasted effort if nobody is watching the
+    # stream, so allow it to be turned off with VISION_ANNOTATE=0
+    annotate = os.environ.get('VISION_ANNOTATE', '1') != '0'
+    # The separate x, y, w, h and time keys are only for dashboards now
+    publish_keys = os.environ.get('VISION_PUBLISH_KEYS', '0') != '0'
+    # Frames are saved here when asked for by the robot, or all the time
+    # if VISION_RECORD=1
+    recorder = FrameRecorder(
+        os.environ.get('VISION_RECORD_DIR', '/home/lvuser/vision_frames'),
+        int(os.environ.get('VISION_RECORD_BYTES', 50 * 1024 * 1024)))
+    record_all = os.environ.get('VISION_RECORD', '0') != '0'
+    # Time each stage and publish the percentiles to vision/perf
+    profiler = StageProfiler() if os.environ.get('VISION_PROFILE', '0') != '0' else None
+    # Our own camera's frame rate and resolution from the mjpg-streamer config
+    try:
+        config = readCaptureConfig(
+            os.environ.get('VISION_MJPG_CONFIG', '/etc/default/mjpg-streamer'),
+            script=os.path.abspath(__file__))
+    except OSError:
+        config = {}
+    fps = config.get('fps', 30.0)
+    width, height = config.get('resolution', (160, 120))
+    # Budget the processing against the frame rate, without shrinking the
+    # frame too far
+    governor = None
+    if os.environ.get('VISION_GOVERNOR', '1') != '0':
+        governor = FrameGovernor(float(os.environ.get('VISION_BUDGET', 0.8)) / fps,
+                                 max_downscale=max(width // 80, 1))
+    # Without a calibration for the lens, assume a perfect one with the
+    # C270's field of view
+    cache_dir = os.environ.get('VISION_CACHE_DIR', '/home/lvuser/.cache/vision')
+    calibration_file = os.environ.get('VISION_CALIBRATION',
+                                      '/home/lvuser/py/vision/calibration.json')
+    try:
+        calibration = CameraCalibration.load(calibration_file, cache_dir)
+    except FileNotFoundError:
+        calibration = CameraCalibration.pinhole(math.radians(45.0), cache_dir=cache_dir)
+    except (OSError, ValueError, KeyError, TypeError):
+        # A broken calibration must not stop us finding the target
+        logging.getLogger("vision").exception("Could not load %s" % calibration_file)
+        calibration = CameraCalibration.pinhole(math.radians(45.0), cache_dir=cache_dir)
+    # Work out the tables now rather than on the first frame
+    calibration.tables(width, height)
+    # Try the colour ranges for different lighting on all the cores at once,
+    # if VISION_PARALLEL=1
+    pipeline = None
+    if os.environ.get('VISION_PARALLEL', '0') != '0':
+        pipeline = ParallelPipeline(annotate, bands=int(os.environ.get('VISION_BANDS', 1)),
+                                    profiler=profiler)
+    ntw = NTWrapper(annotate, publish_keys, recorder, record_all, profiler,
+                    governor=governor, calibration=calibration, pipeline=pipeline)
     return ntw.findTargetNetworkTables
 
 
+def readCaptureConfig(mjpg_config_file, device=None, script=None):
+    """Find the settings for one camera in the mjpg-streamer config file,
+    picked by its device or by the filter script it runs. Returns a dict
+    with the fps, resolution (width, height) and any exposure, brightness,
+    contrast and saturation set on its input, or an empty dict if none of
+    the cameras match."""
+    # The settings are bash arrays, indexed by camera, like FPS[2]=30
+    settings = {}
+    p = re.compile(r'^\s*([A-Z]+)\[([0-9]+)\]=(.*)$')
+    with open(mjpg_config_file) as f:
+        for line in f:
+            match = p.match(line)
+            if match:
+                name, index, value = match.groups()
+                settings.setdefault(int(index), {})[name] = value.strip().strip('"\'')
+    for index, camera in sorted(settings.items()):
+        line = camera.get('INPUT', '')
+        # Follow symlinks to see if they point at the same device or script
+        matched = False
+        for option, path in (('--device', device), ('--fargs', script)):
+            match = re.search(option + ' ([^ \t\n\r\f\v"\']+)', line)
+            if path is not None and match:
+                matched = matched or os.path.realpath(match.group(1)) == os.path.realpath(path)
+        if not matched:
+            continue
+        config = {'index': index}
+        if 'FPS' in camera:
+            config['fps'] = float(camera['FPS'])
+        if 'RESOLUTION' in camera:
+            width, height = camera['RESOLUTION'].split('x')
+            config['resolution'] = (int(width), int(height))
+        # A bunch of regexes to find the parameters
+        for name, option in (('exposure', '-ex'), ('brightness', '-br'),
+                             ('contrast', '-co'), ('saturation', '-sa')):
+            match = re.search(option + ' ([0-9]+)', line)
+            if match:
+                config[name] = int(match.group(1))
+        return config
+    return {}
+
+
 def setCaptureParameters(device,
                          mjpg_config_file='mjpg-streamer'):  # pragma: no cover
     if not os.path.exists(device):
@@ -97,42 +1129,17 @@ def setCaptureParameters(device,
 
     logger = logging.getLogger("vision")
 
-    root_device = os.path.realpath(device)
-
     # Try to find the settings from the mjpg-streamer config file
+    config = readCaptureConfig(mjpg_config_file, device=device)
     v4l2_str = "v4l2-ctl -d %s" % device
-    try:
-        with open(mjpg_config_file) as f:
-            for line in f:
-                # Follow symlinks to see if they point at the same device
-                if "--device" in line:
-                    p = re.compile('--device ([^ \t\n\r\f\v"\']+)')
-                    if os.path.realpath(p.search(line).group(1)) == root_device:
-                        # A bunch of regexes to find the parameters
-                        p = re.compile('-ex ([0-9]+)')
-                        if p.search(line):
-                            v4l2_str += (" -c exposure_auto=1 -c exposure_absolute=%s"
-                                         % p.search(line).group(1))
-                            logger.info("Found exposure setting: %s"
-                                        % p.search(line).group(1))
-                        p = re.compile('-br ([0-9]+)')
-                        if p.search(line):
-                            v4l2_str += " -c brightness=%s" % p.search(line).group(1)
-                            logger.info("Found brightness setting: %s"
-                                        % p.search(line).group(1))
-                        p = re.compile('-co ([0-9]+)')
-                        if p.search(line):
-                            v4l2_str += " -c contrast=%s" % p.search(line).group(1)
-                            logger.info("Found contrast setting: %s"
-                                        % p.search(line).group(1))
-                        p = re.compile('-sa ([0-9]+)')
-                        if p.search(line):
-                            v4l2_str += " -c saturation=%s" % p.search(line).group(1)
-                            logger.info("Found saturation setting: %s"
-                                        % p.search(line).group(1))
-        os.system(v4l2_str)
-    except:
-        raise  # pass  # File not found
+    if 'exposure' in config:
+        v4l2_str += " -c exposure_auto=1 -c exposure_absolute=%d" % config['exposure']
+        logger.info("Found exposure setting: %d" % config['exposure'])
+    for name in ('brightness', 'contrast', 'saturation'):
+        if name in config:
+            v4l2_str += " -c %s=%d" % (name, config[name])
+            logger.info("Found %s setting: %d" % (name, config[name]))
+    os.system(v4l2_str)
 
 # Allow easy capturing of sample images using same settings as on robot
 if __name__ == "__main__":
@@ -174,10 +1181,23 @@ if __name__ == "__main__":
         cv2.waitKey(0)
         cv2.destroyAllWindows()
     if args.video:
+        # Capture and process in their own threads so that waiting on the
+        # camera doesn't add to the latency, and we always process the
+        # newest frame. The main thread just displays the results.
+        ntw = NTWrapper()
+        frames = LatestFrameBuffer()
+        results = LatestFrameBuffer()
+        stop = threading.Event()
+        threading.Thread(target=captureFrames, args=(cap, frames, stop),
+                         daemon=True).start()
+        threading.Thread(target=processFrames,
+                         args=(frames, ntw.findTargetNetworkTables, results),
+                         daemon=True).start()
         window = cv2.namedWindow("preview")
-        while True:
-            retval, image = cap.read()
-            x, y, w, h, image = findTarget(image)
-            cv2.imshow("preview", image)
+        while not results.closed:
+            result = results.get(timeout=0.1)
+            if result is not None:
+                cv2.imshow("preview", result[0])
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
+        stop.set()
@@ -0,0 +1,136 @@
+import argparse
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from vision.shared import FrameRing, ResultSlot
+from vision.vision import (CameraCalibration, TargetTracker, VisionPipeline,
+                           setCaptureParameters)
+
+FRAMES_PATH = '/dev/shm/vision_frames'
+RESULTS_PATH = '/dev/shm/vision_results'
+
+
+def captureToRing(cap, ring, stop):
+    # Read straight into the ring, so the frame is never copied
+    while not stop.is_set():
+        frame = ring.reserve()
+        retval, image = cap.read(frame)
+        if not retval:
+            break
+        if image is not frame:
+            # OpenCV only reads in place if the frame is the right size
+            np.copyto(frame, image)
+        ring.commit(time.time())
+
+
+class VisionWorker:
+    """Finds the target in frames from a FrameRing and writes the results
+    to a ResultSlot, for Vision to read without NetworkTables. The frames
+    are searched in place, so nothing is drawn on them."""
+
+    def __init__(self, ring, results, tracker=None, calibration=None):
+        self.ring = ring
+        self.results = results
+        if tracker is None:
+            tracker = TargetTracker(VisionPipeline(annotate=False))
+        self.tracker = tracker
+        self.calibration = calibration
+        self.sequence = 0
+        self.processed = 0
+        self.dropped = 0  # Frames replaced before we got to them
+        self.torn = 0  # Frames overwritten while we were processing them
+
+    def processFrame(self, frame, timestamp):
+        x, y, w, h, _ = self.tracker.findTarget(frame)
+        # NaN tells Vision to work the bearing out from x itself
+        bearing = elevation = float('nan')
+        if self.calibration is not None and w > 0.0:
+            bearing, elevation = self.calibration.angles(x, y, frame.shape[1],
+                                                         frame.shape[0])
+        return x, y, w, h, bearing, elevation
+
+    def step(self, timeout=None):
+        """Process the newest frame, returning False if there wasn't one."""
+        if self.ring.latest < self.sequence:
+            # The capture was restarted and created the ring again, so
+            # start counting from its first frame
+            self.sequence = 0
+            self.tracker.reset()
+        item = self.ring.get(self.sequence, timeout)
+        if item is None:
+            return False
+        frame, timestamp, sequence = item
+        if self.sequence:
+            self.dropped += sequence - self.sequence - 1
+        self.sequence = sequence
+        result = self.processFrame(frame, timestamp)
+        if not self.ring.valid(sequence):
+            # The capture lapped the ring, so the result can't be trusted
+            self.torn += 1
+            return True
+        # Number the results with the frames, so gaps show up in Vision
+        self.results.write((sequence, timestamp) + result)
+        self.processed += 1
+        return True
+
+    def run(self, stop, timeout=0.1):
+        while not stop.is_set():
+            self.step(timeout)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        description='Run vision in its own processes, handing frames and results '
+                    'over through shared memory instead of mjpg-streamer and '
+                    'NetworkTables.')
+    parser.add_argument('role', choices=('capture', 'process'),
+                        help='capture frames from the camera into the ring, or '
+                        'process frames from the ring')
+    parser.add_argument('--frames', help='shared memory file for the frames',
+                        default=FRAMES_PATH)
+    parser.add_argument('--results', help='shared memory file for the results',
+                        default=RESULTS_PATH)
+    parser.add_argument('--device', help='capture device',
+                        default='/dev/v4l/by-id/usb-046d_0825_96EBCE50-video-index0')
+    parser.add_argument('--config', help='mjpg-streamer config with the camera settings',
+                        default='/etc/default/mjpg-streamer')
+    parser.add_argument('--slots', help='frames in the ring', type=int, default=4)
+    parser.add_argument('--calibration', help='lens calibration from vision.calibrate',
+                        default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=20)  # Show info messages
+    logger = logging.getLogger("vision")
+    stop = threading.Event()
+    if args.role == 'capture':
+        setCaptureParameters(args.device, args.config)
+        cap = cv2.VideoCapture(args.device)
+        retval, image = cap.read()
+        if not retval:
+            raise Exception("Could not read from %s" % args.device)
+        ring = FrameRing.create(args.frames, image.shape, args.slots)
+        try:
+            captureToRing(cap, ring, stop)
+        finally:
+            cap.release()
+    else:
+        while not os.path.exists(args.frames):
+            logger.info("Waiting for frames in %s" % args.frames)
+            time.sleep(1.0)
+        ring = FrameRing.open(args.frames)
+        calibration = None
+        if args.calibration:
+            calibration = CameraCalibration.load(args.calibration)
+            calibration.tables(ring.shape[1], ring.shape[0])
+        worker = VisionWorker(ring, ResultSlot.create(args.results),
+                              calibration=calibration)
+        try:
+            worker.run(stop)
+        except KeyboardInterrupt:
+            logger.info("Processed %d frames, %d dropped, %d torn"
+                        % (worker.processed, worker.dropped, worker.torn))